@@ -0,0 +1,216 @@
+#! /usr/bin/env python
+'''
+Benchmarks of av_utils with the workloads of the notebooks 06-15.
+
+    python av_benchmark.py                         # runs all the benchmarks and prints a table
+    python av_benchmark.py -o before.json          # saves the results
+    python av_benchmark.py -c before.json          # compares with saved results
+    python av_benchmark.py -k line_integral -r 5   # only the benchmarks with `line_integral` in the name, 5 repeats
+    python av_benchmark.py --phases                # also the time of each phase (simplify, integrate, lambdify, ...)
+
+The wall time is measured with time.perf_counter and the peak memory (of the Python allocations, NumPy included)
+with tracemalloc in a separate run. The lambdify cache is cleared before each run unless --warm is given.
+'''
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import sympy as sp
+import sympy.vector as sv
+import plotly
+
+import av_utils as av
+
+R = sv.CoordSys3D('R')
+x, y, z, t = sp.symbols('x y z t')
+
+# the registered benchmarks as (name, variant, parameters, workload)
+_benchmarks = []
+
+def benchmark(name, variant, **params):
+    '''
+    Registers a workload. `variant` is 'symbolic' or 'numeric' and `params` describe the size of the problem
+    '''
+    def register(func):
+        _benchmarks.append((name, variant, params, lambda: func(**params)))
+        return func
+    return register
+
+# 06 / 07: the gravitational field on grids of several sizes
+def gravitation(x, y, z, G=1, m=1, M=10):
+    return -((G*m*M)/(x**2 + y**2 + z**2)**(3/2))*(x*R.i + y*R.j + z*R.k)
+
+for _points in (10, 20, 40):
+    @benchmark('plot3d_vector_field', 'numeric', points=_points)
+    def _vector_field(points):
+        return av.plot3d_vector_field(gravitation(x, y, z), (x, -15, 15), (y, -15, 15), (z, -15, 15), points=points)
+
+# 08: scalar line integral along a helix
+helix = sp.cos(t)*R.i + sp.sin(t)*R.j + t*R.k
+
+@benchmark('line_integral_scalar', 'symbolic', turns=2)
+def _line_scalar_symbolic(turns):
+    return av.line_integral_scalar(z**2 + x*y, helix, (t, 0, 2*turns*sp.pi))
+
+@benchmark('line_integral_scalar', 'numeric', turns=2)
+def _line_scalar_numeric(turns):
+    return av.line_integral_scalar(z**2 + x*y, helix, (t, 0, 2*turns*sp.pi), method='numeric')
+
+# 09 / 10: vectorial line integral over a closed polygon
+def polygon(sides):
+    angles = np.linspace(0, 2*np.pi, sides + 1)
+    return av.lines([(round(float(np.cos(a)), 6), round(float(np.sin(a)), 6), 0) for a in angles], coordinate=R)
+
+for _sides in (8, 64):
+    @benchmark('line_integral_vectorial', 'symbolic', sides=_sides)
+    def _line_vectorial_symbolic(sides):
+        return av.line_integral_vectorial(x**4*R.i + x*y*R.j, polygon(sides), (t, 0, 1))
+
+    @benchmark('line_integral_vectorial', 'numeric', sides=_sides)
+    def _line_vectorial_numeric(sides):
+        return av.line_integral_vectorial(x**4*R.i + x*y*R.j, polygon(sides), (t, 0, 1), method='numeric')
+
+# 11: minimum of a function of two variables
+@benchmark('gradient_descent', 'numeric', seeds=None)
+@benchmark('gradient_descent', 'numeric', seeds=64)
+def _gradient_descent(seeds):
+    return av.gradient_descent((x - 1)**2 + (y + 2)**2 + sp.sin(x*y), [(x, -3, 3), (y, -3, 3)], epochs=1000,
+                               seeds=seeds, seed=0)
+
+# 06: the density of a scalar field, as a volume for plotly or as a mesh of its isosurfaces
+for _points in (30, 60):
+    for _method in ('isosurface', 'mesh'):
+        @benchmark('plot3d_density_function', 'numeric', points=_points, method=_method)
+        def _density(points, method):
+            return av.plot3d_density_function(25 - x**2 - y**2 - z**2, (x, -7, 7), (y, -7, 7), (z, -7, 7),
+                                              points=points, method=method)
+
+# the label of a benchmark in the tables and in the saved results
+def _label(name, variant, params):
+    args = ', '.join(f'{key}={value}' for key, value in params.items())
+    return f'{name}[{variant}]({args})'
+
+# timing and peak memory of one workload
+def measure(workload, repeat=3, warm=False, phases=False):
+    '''
+    - Return:
+        a dict with the best, the median and all the wall times in seconds and the peak memory in MB.
+        With `phases`, also the seconds of each phase in one more run with av.profile
+    '''
+    times = []
+    for _ in range(repeat):
+        if not warm:
+            av.lambdify_cache_clear()
+        start = time.perf_counter()
+        workload()
+        times.append(time.perf_counter() - start)
+
+    if not warm:
+        av.lambdify_cache_clear()
+    tracemalloc.start()
+    try:
+        workload()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    result = {'best': min(times), 'median': float(np.median(times)), 'times': times, 'peak_mb': peak/2**20}
+    if phases:
+        if not warm:
+            av.lambdify_cache_clear()
+        with av.profile() as prof:
+            workload()
+        result['phases'] = prof.summary(by='phase')['seconds'].to_dict()
+    return result
+
+def run(keyword=None, repeat=3, warm=False, verbose=True, phases=False):
+    '''
+    Runs the benchmarks whose label contains `keyword` and returns the results as a list of dicts
+    '''
+    results = []
+    for name, variant, params, workload in _benchmarks:
+        label = _label(name, variant, params)
+        if keyword and keyword not in label:
+            continue
+        result = {'label': label, 'name': name, 'variant': variant, 'params': params}
+        result.update(measure(workload, repeat, warm, phases))
+        results.append(result)
+        if verbose:
+            print(f"{label:<70} {result['best']:10.4f} s {result['peak_mb']:10.1f} MB", flush=True)
+            if phases:
+                print(' '*4 + ', '.join(f'{phase} {seconds:.4f} s' for phase, seconds in result['phases'].items()))
+    return results
+
+# total time of the symbolic and the numeric variants of each function
+def split(results):
+    table = {}
+    for result in results:
+        table.setdefault(result['name'], {}).setdefault(result['variant'], 0.0)
+        table[result['name']][result['variant']] += result['best']
+    return table
+
+def compare(results, previous, threshold=1.25):
+    '''
+    Prints the ratio of the new to the old best times. Returns the labels slower than `threshold` times the old ones
+    '''
+    old = {result['label']: result for result in previous['results']}
+    slower = []
+    print(f"\n{'benchmark':<70} {'old (s)':>10} {'new (s)':>10} {'ratio':>7}")
+    for result in results:
+        if result['label'] not in old:
+            continue
+        before = old[result['label']]['best']
+        ratio = result['best']/before if before > 0 else float('inf')
+        flag = '  slower' if ratio > threshold else ('  faster' if ratio < 1/threshold else '')
+        if ratio > threshold:
+            slower.append(result['label'])
+        print(f"{result['label']:<70} {before:10.4f} {result['best']:10.4f} {ratio:7.2f}{flag}")
+    return slower
+
+def metadata():
+    return {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'numpy': np.__version__, 'sympy': sp.__version__, 'plotly': plotly.__version__}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of av_utils')
+    parser.add_argument('-k', '--keyword', help='run only the benchmarks with this text in the label')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='the number of timed runs of each benchmark')
+    parser.add_argument('-o', '--output', help='save the results in this JSON file')
+    parser.add_argument('-c', '--compare', help='compare with the results saved in this JSON file')
+    parser.add_argument('-t', '--threshold', type=float, default=1.25, help='the ratio of times reported as slower')
+    parser.add_argument('--warm', action='store_true', help="don't clear the lambdify cache before each run")
+    parser.add_argument('--phases', action='store_true', help='report the time of each phase with av.profile')
+    parser.add_argument('--list', action='store_true', help='list the benchmarks')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, variant, params, _ in _benchmarks:
+            print(_label(name, variant, params))
+        return 0
+
+    results = run(args.keyword, args.repeat, args.warm, phases=args.phases)
+
+    print(f"\n{'function':<30} {'symbolic (s)':>14} {'numeric (s)':>14}")
+    for name, variants in split(results).items():
+        print(f"{name:<30} {variants.get('symbolic', float('nan')):14.4f} {variants.get('numeric', float('nan')):14.4f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': metadata(), 'repeat': args.repeat, 'warm': args.warm, 'results': results}, f, indent=1)
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        if compare(results, previous, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
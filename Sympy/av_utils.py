@@ -7,6 +7,250 @@ import numpy as np
 import sympy.vector as sv
 import plotly.figure_factory as ff
 from collections.abc import Iterable
+from functools import cached_property, lru_cache, wraps
+from contextlib import contextmanager, nullcontext
+from collections import OrderedDict, deque
+import math
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
+import threading
+import time
+import base64
+import uuid
+from plotly.io.json import to_json_plotly
+from plotly.offline import get_plotlyjs, get_plotlyjs_version
+
+
+# Session-wide cache of the callables compiled by sp.lambdify.
+# The key is built from the structure of the expression, the order of the arguments and the backend module.
+_lambdify_cache = OrderedDict()
+_lambdify_cache_info = {'hits': 0, 'misses': 0, 'maxsize': 256}
+
+def _freeze(obj):
+    # lists, tuples and mutable matrices aren't hashable, so they are converted into nested tuples
+    if isinstance(obj, sp.MatrixBase):
+        return ('matrix', obj.shape, tuple(_freeze(item) for item in obj))
+    if isinstance(obj, (list, tuple)):
+        return (type(obj).__name__, tuple(_freeze(item) for item in obj))
+    if isinstance(obj, dict):
+        return ('dict', tuple((_freeze(k), _freeze(v)) for k, v in obj.items()))
+    return obj
+
+def cached_lambdify(args, expr, modules=None, **kwargs):
+    '''
+    - Arguments:
+        `args`: the variables of the expression, the same as the first argument of `sp.lambdify`
+        `expr`: a Sympy expression, or a list/tuple of them
+        `modules`: the backend module passed to `sp.lambdify`, e.g. 'numpy'
+        `kwargs`: other keyword arguments of `sp.lambdify`, e.g. `cse=True`
+    - Return:
+        the compiled function. If the same expression was compiled before with the same arguments
+        and module, the cached function is returned without calling `sp.lambdify` again.
+    '''
+    key = (_freeze(args), _freeze(expr), _freeze(modules), _freeze(sorted(kwargs.items())))
+    try:
+        func = _lambdify_cache[key]
+    except TypeError:
+        # an unhashable argument. It can't be cached
+        _lambdify_cache_info['misses'] += 1
+        with _phase('lambdify'):
+            func = sp.lambdify(args, expr, modules, **kwargs)
+        return func if _profile_state is None else _timed_evaluate(func)
+    except KeyError:
+        _lambdify_cache_info['misses'] += 1
+        with _phase('lambdify'):
+            func = sp.lambdify(args, expr, modules, **kwargs)
+        _lambdify_cache[key] = func
+        while len(_lambdify_cache) > _lambdify_cache_info['maxsize']:
+            _lambdify_cache.popitem(last=False)
+        return func if _profile_state is None else _timed_evaluate(func)
+
+    _lambdify_cache_info['hits'] += 1
+    _lambdify_cache.move_to_end(key)
+    return func if _profile_state is None else _timed_evaluate(func)
+
+def lambdify_cache_info():
+    '''
+    - Return:
+        a dictionary with the number of hits and misses, the maximum size and the current size of the cache
+    '''
+    return dict(_lambdify_cache_info, currsize=len(_lambdify_cache))
+
+def lambdify_cache_clear(maxsize=None):
+    '''
+    Empty the cache of compiled functions and reset the counters.
+    `maxsize`: optional. the new maximum number of functions kept in the cache
+    '''
+    _lambdify_cache.clear()
+    _lambdify_cache_info['hits'] = 0
+    _lambdify_cache_info['misses'] = 0
+    if maxsize is not None:
+        assert maxsize > 0, 'the size of the cache must be positive'
+        _lambdify_cache_info['maxsize'] = maxsize
+
+# Opt-in profiling. Inside `with profile() as prof:` every call of a public function of this module is timed and the time
+# is split in the phases simplify, integrate, lambdify, evaluate and figure. Outside of it the hooks do nothing.
+_profile_state = None
+_no_phase = nullcontext()
+
+class Profile:
+    '''
+    The timings recorded by `profile`.
+    - Attributes:
+        `records`: a dict {(function, phase): [calls, seconds]}. The phase 'total' is the whole time of the calls
+        of a function and 'other' the part of it out of the phases. The phases are attributed to the outermost
+        public function running in the thread
+    '''
+    def __init__(self):
+        self.records = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _record(self, function, phase, seconds):
+        with self._lock:
+            record = self.records.setdefault((function, phase), [0, 0.0])
+            record[0] += 1
+            record[1] += seconds
+
+    def summary(self, by='function'):
+        '''
+        - Arguments:
+            `by`: 'function' for a row for each function and phase, 'phase' for the total of each phase
+        - Return:
+            a DataFrame with the number of calls and the time in seconds (and its share of the function's total)
+        '''
+        assert by in ['function', 'phase'], "by must be 'function' or 'phase'"
+        table = pd.DataFrame([(function, phase, calls, seconds) for (function, phase), (calls, seconds) in self.records.items()],
+                             columns=['function', 'phase', 'calls', 'seconds'])
+        if by == 'phase':
+            table = table[table['phase'] != 'total'].groupby('phase')[['calls', 'seconds']].sum()
+            return table.sort_values('seconds', ascending=False)
+
+        totals = table[table['phase'] == 'total'].set_index('function')['seconds']
+        table['share'] = table['seconds']/table['function'].map(totals)
+        table['order'] = table['function'].map(totals).fillna(0)
+        table = table.sort_values(['order', 'function', 'seconds'], ascending=[False, True, False])
+        return table.drop(columns='order').reset_index(drop=True)
+
+# timing of a phase inside a public function. The time of the phases started inside it is not counted twice
+class _PhaseTimer:
+    def __init__(self, prof, name):
+        self.prof = prof
+        self.name = name
+
+    def __enter__(self):
+        stack = self.prof._local.__dict__.setdefault('phases', [])
+        # e.g. add_surface calls add_trace: both are the same phase
+        self.nested = bool(stack) and stack[-1][0] == self.name
+        if not self.nested:
+            stack.append([self.name, time.perf_counter(), 0.0])
+        return self
+
+    def __exit__(self, *exc):
+        if self.nested:
+            return False
+        local = self.prof._local
+        name, start, inner = local.phases.pop()
+        elapsed = time.perf_counter() - start
+        self.prof._record(getattr(local, 'function', None), name, elapsed - inner)
+        if local.phases:
+            local.phases[-1][2] += elapsed
+        else:
+            local.in_phases = getattr(local, 'in_phases', 0.0) + elapsed
+        return False
+
+def _phase(name):
+    if _profile_state is None:
+        return _no_phase
+    return _PhaseTimer(_profile_state, name)
+
+# a compiled function whose calls are the phase 'evaluate'
+def _timed_evaluate(func):
+    @wraps(func)
+    def timed(*args, **kwargs):
+        with _phase('evaluate'):
+            return func(*args, **kwargs)
+    return timed
+
+# the calls of plotly that build the figures are the phase 'figure'
+def _figure_methods():
+    return [name for name in dir(go.Figure) if name == '__init__' or name.startswith(('add_', 'update_'))]
+
+def _timed_figure(method):
+    @wraps(method)
+    def timed(*args, **kwargs):
+        with _phase('figure'):
+            return method(*args, **kwargs)
+    return timed
+
+@contextmanager
+def profile():
+    '''
+    Records the time of the public functions of av_utils and of their phases: simplify, integrate, lambdify,
+    evaluate (the compiled functions) and figure (the plotly figures). The symbolic work done in other processes
+    (e.g. `workers` of the line integrals) isn't recorded.
+
+    Example:
+    ========
+    >>> with av.profile() as prof:
+    ...     av.line_integral_scalar(z**2 + x, helix, (t, 0, 2*sp.pi))
+    >>> prof.summary()
+    '''
+    global _profile_state
+    assert _profile_state is None, "profile can't be nested"
+    prof = Profile()
+    methods = {name: go.Figure.__dict__[name] for name in _figure_methods() if name in go.Figure.__dict__}
+    for name in _figure_methods():
+        setattr(go.Figure, name, _timed_figure(getattr(go.Figure, name)))
+    _profile_state = prof
+    try:
+        yield prof
+    finally:
+        _profile_state = None
+        for name in _figure_methods():
+            if name in methods:
+                setattr(go.Figure, name, methods[name])
+            else:
+                delattr(go.Figure, name)
+
+# times the calls of a public function when the profiling is on
+def _profiled(func):
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        prof = _profile_state
+        if prof is None:
+            return func(*args, **kwargs)
+        local = prof._local
+        outermost = getattr(local, 'function', None) is None
+        if outermost:
+            local.function, local.in_phases = name, 0.0
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            prof._record(name, 'total', elapsed)
+            if outermost:
+                prof._record(name, 'other', elapsed - local.in_phases)
+                local.function = None
+    return wrapper
+
+# one compiled function for all the components of a field, with the common subexpressions computed once.
+# It returns the components stacked in a preallocated array with the shape (number of components, *grid shape)
+def _fused_lambdify(vars, components):
+    components = list(components)
+    func_np = cached_lambdify(vars, components, 'numpy', cse=True)
+
+    def fused(*args):
+        out = np.empty((len(components),) + np.broadcast(*args).shape)
+        for ind, value in enumerate(func_np(*args)):
+            # constant components are broadcast to the shape of the grid
+            out[ind] = value
+        return out
+    return fused
 
 
 # 2D curve plot. A wrapper for plotly scatter plot
@@ -57,14 +301,224 @@ def plot_curve3d(x, y, z, fig=None, xtitle='X', ytitle='Y', title='3D Plot', asp
     return fig
 
 
+# sampling a curve adaptively: the segments where the curve turns more than `angle` degrees are bisected
+def _adaptive_sample(curve_np, a, b, points=50, angle=10, max_points=2000, max_depth=12, break_ratio=0.25):
+    '''
+    - Arguments:
+        `curve_np`: a vectorized function that maps an array of parameters with the shape (n,) to the points of the curve (k, n)
+        `a`, `b`: the endpoints of the interval of the parameter
+        `points`: the number of points of the initial uniform sampling
+        `angle`: the maximum turning angle, in degrees, between two consecutive segments
+        `max_points`: the budget of points
+        `max_depth`: the maximum number of bisections of a segment of the initial sampling
+        `break_ratio`: a segment that can't be refined anymore and is longer than this fraction of the size of the curve
+        is a discontinuity (e.g. a pole) and it is broken
+    - Return:
+        the parameters and the points of the curve. The breaks are marked with NaN.
+    '''
+    a, b = float(a), float(b)
+    t = np.linspace(a, b, points)
+    P = curve_np(t)
+    min_width = (b - a)/(points - 1)/2**max_depth
+    limit = np.radians(angle)
+
+    # the size of the curve is measured on the uniform sampling, because the refinement concentrates points near the poles
+    finite = np.all(np.isfinite(P), axis=0)
+    extent = 0
+    if finite.sum() > 2:
+        extent = np.linalg.norm(np.percentile(P[:, finite], 95, axis=1) - np.percentile(P[:, finite], 5, axis=1))
+
+    def turning(P):
+        d = np.diff(P, axis=1)
+        v1, v2 = d[:, :-1], d[:, 1:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cos = np.sum(v1*v2, axis=0)/(np.linalg.norm(v1, axis=0)*np.linalg.norm(v2, axis=0))
+        return np.nan_to_num(np.arccos(np.clip(cos, -1, 1)), nan=0.0)
+
+    while len(t) < max_points:
+        finite = np.all(np.isfinite(P), axis=0)
+        ang = turning(P)
+
+        # the priority of a segment is the largest turning angle at its endpoints
+        priority = np.zeros(len(t) - 1)
+        priority[:-1] = ang
+        priority[1:] = np.maximum(priority[1:], ang)
+        # the segments between a finite and a non-finite point are refined to locate the break
+        priority[finite[:-1] != finite[1:]] = np.pi
+
+        flag = (priority > limit) & (np.diff(t) > min_width)
+        if not flag.any():
+            break
+        idx = np.flatnonzero(flag)
+        budget = max_points - len(t)
+        if len(idx) > budget:
+            idx = np.sort(idx[np.argsort(-priority[idx])[:budget]])
+
+        t_new = (t[idx] + t[idx + 1])/2
+        t = np.concatenate([t, t_new])
+        P = np.concatenate([P, curve_np(t_new)], axis=1)
+        order = np.argsort(t, kind='stable')
+        t, P = t[order], P[:, order]
+
+    # breaking the long segments that reached the maximum depth, like the jump of tan(x) at pi/2.
+    # On a continuous piece the point in the middle of the segment stays close to the middle of the chord
+    # infinite values are also breaks
+    P[:, ~np.all(np.isfinite(P), axis=0)] = np.nan
+    if extent > 0:
+        chord = np.linalg.norm(np.diff(P, axis=1), axis=0)
+        jump = np.flatnonzero((np.diff(t) <= 2*min_width) & (chord > break_ratio*extent))
+        if len(jump) > 0:
+            middle = curve_np((t[jump] + t[jump + 1])/2)
+            deviation = np.linalg.norm(middle - (P[:, jump] + P[:, jump + 1])/2, axis=0)
+            jump = jump[~(deviation <= 0.4*chord[jump])]
+        if len(jump) > 0:
+            t = np.insert(t, jump + 1, (t[jump] + t[jump + 1])/2)
+            P = np.insert(P, jump + 1, np.nan, axis=1)
+
+    return t, P
+
+# the zero level of a function of two variables by marching squares on a quadtree.
+# Only the cells where the function changes sign are refined, so the work grows with the length of the curve
+def _implicit_polylines(func_np, inter1, inter2, points=50, depth=3):
+    '''
+    - Arguments:
+        `func_np`: a vectorized function of two variables
+        `inter1`, `inter2`: (variable, start, end)
+        `points`: the number of points of the initial grid along each axis
+        `depth`: the number of times that the cells with a sign change are divided in four
+    - Return:
+        the x and y coordinates of the polylines, separated by NaN. The vertices closer than a quarter of the
+        finest cell to the polyline without them are dropped
+    '''
+    x0, x1, y0, y1 = float(inter1[1]), float(inter1[2]), float(inter2[1]), float(inter2[2])
+    # the corners of all the cells are on the integer lattice of the finest level
+    M = (points - 1)*2**depth
+    hx, hy = (x1 - x0)/M, (y1 - y0)/M
+
+    def values_at(i, j):
+        keys, inverse = np.unique(j*(M + 1) + i, return_inverse=True)
+        values = _evaluate(func_np, x0 + (keys % (M + 1))*hx, y0 + (keys // (M + 1))*hy)
+        return values[inverse.reshape(i.shape)]
+
+    ci, cj = [c.ravel() for c in np.meshgrid(np.arange(points - 1), np.arange(points - 1))]
+    size = 2**depth
+    for level in range(depth + 1):
+        i, j = ci*size, cj*size
+        corners = np.array([(i, j), (i + size, j), (i + size, j + size), (i, j + size)])
+        v = values_at(corners[:, 0], corners[:, 1])
+        crossing = np.all(np.isfinite(v), axis=0) & (v.min(axis=0) <= 0) & (v.max(axis=0) > 0)
+        ci, cj, v = ci[crossing], cj[crossing], v[:, crossing]
+        if level == depth:
+            break
+        ci = np.concatenate([2*ci, 2*ci + 1, 2*ci, 2*ci + 1])
+        cj = np.concatenate([2*cj, 2*cj, 2*cj + 1, 2*cj + 1])
+        size //= 2
+
+    if len(ci) == 0:
+        return np.array([]), np.array([])
+
+    # the edges of a cell: bottom, right, top and left, with their end corners and their ids on the lattice
+    v00, v10, v11, v01 = v
+    ends = [(v00, v10), (v10, v11), (v01, v11), (v00, v01)]
+    start_i = np.array([ci, ci + 1, ci, ci])
+    start_j = np.array([cj, cj, cj + 1, cj])
+    horizontal = np.array([1, 0, 1, 0])[:, None]
+    edge_id = 2*(start_j*(M + 1) + start_i) + (1 - horizontal)
+    cut = np.array([(va > 0) != (vb > 0) for va, vb in ends])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        frac = np.array([va/(va - vb) for va, vb in ends])
+    px = x0 + (start_i + horizontal*frac)*hx
+    py = y0 + (start_j + (1 - horizontal)*frac)*hy
+
+    # two cut edges make one segment. Four cut edges (a saddle) make two segments, decided by the center value
+    count = cut.sum(axis=0)
+    simple = np.flatnonzero(count == 2)
+    first = np.argmax(cut[:, simple], axis=0)
+    second = 3 - np.argmax(cut[::-1, simple], axis=0)
+    pairs = [(simple, first, second)]
+    saddle = np.flatnonzero(count == 4)
+    if len(saddle) > 0:
+        same = (v00[saddle] > 0) == (v[:, saddle].mean(axis=0) > 0)
+        pairs.append((saddle, np.where(same, 0, 3), np.where(same, 1, 0)))
+        pairs.append((saddle, np.where(same, 3, 1), np.where(same, 2, 2)))
+    cells = np.concatenate([p[0] for p in pairs])
+    edge_a = np.concatenate([p[1] for p in pairs])
+    edge_b = np.concatenate([p[2] for p in pairs])
+
+    # chaining the segments into polylines through the shared edges
+    ids = np.concatenate([edge_id[edge_a, cells], edge_id[edge_b, cells]])
+    nodes, inverse = np.unique(ids, return_inverse=True)
+    node_x, node_y = np.empty(len(nodes)), np.empty(len(nodes))
+    node_x[inverse] = np.concatenate([px[edge_a, cells], px[edge_b, cells]])
+    node_y[inverse] = np.concatenate([py[edge_a, cells], py[edge_b, cells]])
+    n = len(cells)
+    seg_a, seg_b = inverse[:n], inverse[n:]
+
+    neighbors = -np.ones((len(nodes), 2), dtype=int)
+    for seg, node in enumerate(np.concatenate([seg_a, seg_b])):
+        seg %= n
+        neighbors[node, 0 if neighbors[node, 0] < 0 else 1] = seg
+
+    used = np.zeros(n, dtype=bool)
+    lines_x, lines_y = [], []
+    for seg in range(n):
+        if used[seg]:
+            continue
+        used[seg] = True
+        chain = [seg_a[seg], seg_b[seg]]
+        # walking forward from the end of the segment and then backward from its start
+        for direction in (1, -1):
+            node = chain[-1] if direction == 1 else chain[0]
+            while True:
+                nxt = [s_ for s_ in neighbors[node] if s_ >= 0 and not used[s_]]
+                if not nxt:
+                    break
+                used[nxt[0]] = True
+                node = seg_b[nxt[0]] if seg_a[nxt[0]] == node else seg_a[nxt[0]]
+                if direction == 1:
+                    chain.append(node)
+                else:
+                    chain.insert(0, node)
+        keep = _simplify_polyline(node_x[chain], node_y[chain], np.hypot(hx, hy)/4)
+        lines_x.append(np.append(node_x[chain][keep], np.nan))
+        lines_y.append(np.append(node_y[chain][keep], np.nan))
+
+    return np.concatenate(lines_x), np.concatenate(lines_y)
+
+# Ramer-Douglas-Peucker simplification. The indices of the vertices kept so that the polyline moves less than eps
+def _simplify_polyline(x, y, eps):
+    keep = np.zeros(len(x), dtype=bool)
+    keep[[0, -1]] = True
+    stack = [(0, len(x) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        px, py = x[first+1:last] - x[first], y[first+1:last] - y[first]
+        chord = np.hypot(dx, dy)
+        if chord > 0:
+            distance = np.abs(px*dy - py*dx)/chord
+        else:
+            # a closed polyline: the distance to its first point
+            distance = np.hypot(px, py)
+        far = np.argmax(distance)
+        if distance[far] > eps:
+            middle = first + 1 + far
+            keep[middle] = True
+            stack += [(first, middle), (middle, last)]
+    return keep
+
 # plot a 2D implicit function like a circle or an ellipse.
 def plot_implicit(func, inter1=None, inter2=None, fig=None, xtitle='X',
-                  ytitle='Y', title=None, points=50, colorscale = 'Blues'):
+                  ytitle='Y', title=None, points=50, colorscale = 'Blues', adaptive=False, depth=3):
     '''
     - Argument:
         `func`: must be a function like g(y)+f(x)=0 (just the left handside) or as a sp.Eq() object
         `inter1`: (variable1, start, end)
         `inter2`: (variable2, start, end)
+        `adaptive`: if True, the cells of the `points`x`points` grid where the function changes sign are refined `depth` times
+        and the curve is drawn as polylines in one scatter trace instead of a contour of the whole grid
     -Return:
         a Plotly graph object
 
@@ -94,7 +548,17 @@ def plot_implicit(func, inter1=None, inter2=None, fig=None, xtitle='X',
 
     # assert func.free_symbols == set([inter1[0], inter2[0]]), "The variables of the function aren't the same as the declared in the intervals"
 
-    func_np = sp.lambdify([inter1[0], inter2[0]], func)
+    func_np = cached_lambdify([inter1[0], inter2[0]], func)
+
+    if adaptive:
+        xx, yy = _implicit_polylines(func_np, inter1, inter2, points, depth)
+        if fig is None:
+            fig = go.Figure()
+        fig.add_scatter(x=xx, y=yy, showlegend=False, name=str(func), mode='lines', line_width=2)
+        fig.update_layout(title=title, xaxis_title=xtitle,
+                          yaxis_title=ytitle,
+                          yaxis=dict(scaleanchor="x", scaleratio=1))
+        return fig
 
     xx = np.linspace(inter1[1], inter1[2], points)
     yy = np.linspace(inter2[1], inter2[2], points)
@@ -122,7 +586,7 @@ def plot_implicit(func, inter1=None, inter2=None, fig=None, xtitle='X',
 
 # Plot a parametric curve in 2D
 def plot_parametric_curve(func, inter1=None, fig=None, xtitle='X', ytitle='Y', 
-                            title='Curve Plot', points=50,
+                            title='Curve Plot', points=50, adaptive=False, angle=10, max_points=2000,
                             ):
 
     '''
@@ -134,6 +598,8 @@ def plot_parametric_curve(func, inter1=None, fig=None, xtitle='X', ytitle='Y',
         `ytitle`: y-axis title
         `title`: title of the figure
         `points`: the number of points to plot the curve
+        `adaptive`: if True, the segments where the curve turns more than `angle` degrees are refined recursively,
+        starting from `points` uniform points and using at most `max_points` points. Non-finite values and jumps are drawn as breaks
     - Return:
         A figure object of Plotly
     '''
@@ -152,19 +618,23 @@ def plot_parametric_curve(func, inter1=None, fig=None, xtitle='X', ytitle='Y',
     params_unique = set([item for sublist in params for item in sublist])
     assert params_unique == set([inter1[0]]), "The parameters of the function aren't the same as the ones declared in the intervals"
 
-    xx_np = sp.lambdify(inter1[0], func[0])
-    yy_np = sp.lambdify(inter1[0], func[1])
+    if adaptive:
+        curve_np = _fused_lambdify(inter1[0], func)
+        var1, (xx, yy) = _adaptive_sample(curve_np, inter1[1], inter1[2], points, angle, max_points)
+    else:
+        xx_np = cached_lambdify(inter1[0], func[0])
+        yy_np = cached_lambdify(inter1[0], func[1])
 
-    var1 = np.linspace(inter1[1], inter1[2], points)
-    xx, yy = xx_np(var1), yy_np(var1)
-    #xx, yy, zz = xx_np(var1), yy_np(var1), zz_np(var1)
+        var1 = np.linspace(inter1[1], inter1[2], points)
+        xx, yy = xx_np(var1), yy_np(var1)
+        #xx, yy, zz = xx_np(var1), yy_np(var1), zz_np(var1)
 
-    l = list([xx, yy])
-    for item in range(len(l)):
-        if type(item) != np.ndarray:
-            l[item] *= np.ones(var1.shape)
+        l = list([xx, yy])
+        for item in range(len(l)):
+            if type(item) != np.ndarray:
+                l[item] *= np.ones(var1.shape)
 
-    xx, yy = l[0], l[1]
+        xx, yy = l[0], l[1]
 
     if fig is None:
 
@@ -177,7 +647,7 @@ def plot_parametric_curve(func, inter1=None, fig=None, xtitle='X', ytitle='Y',
 # Plot a parametric curve in 3D
 def plot3d_parametric_curve(func, inter1=None, fig=None, xtitle='X', ytitle='Y', 
                             title='3D Curve Plot', points=50, line = None,
-                            aspectmode='data'):
+                            aspectmode='data', adaptive=False, angle=10, max_points=2000):
 
     '''
     - Arguments:
@@ -189,6 +659,8 @@ def plot3d_parametric_curve(func, inter1=None, fig=None, xtitle='X', ytitle='Y',
         `title`: title of the figure
         `points`: the number of points to plot the curve
         `aspectmode`: a parameter of figure object
+        `adaptive`: if True, the segments where the curve turns more than `angle` degrees are refined recursively,
+        starting from `points` uniform points and using at most `max_points` points. Non-finite values and jumps are drawn as breaks
     - Return:
         A figure object of Plotly
     '''
@@ -207,19 +679,23 @@ def plot3d_parametric_curve(func, inter1=None, fig=None, xtitle='X', ytitle='Y',
     params_unique = set([item for sublist in params for item in sublist])
     assert params_unique == set([inter1[0]]), "The parameters of the function aren't the same as the ones declared in the intervals"
 
-    xx_np = sp.lambdify(inter1[0], func[0])
-    yy_np = sp.lambdify(inter1[0], func[1])
-    zz_np = sp.lambdify(inter1[0], func[2])
+    if adaptive:
+        curve_np = _fused_lambdify(inter1[0], func)
+        var1, (xx, yy, zz) = _adaptive_sample(curve_np, inter1[1], inter1[2], points, angle, max_points)
+    else:
+        xx_np = cached_lambdify(inter1[0], func[0])
+        yy_np = cached_lambdify(inter1[0], func[1])
+        zz_np = cached_lambdify(inter1[0], func[2])
 
-    var1 = np.linspace(inter1[1], inter1[2], points)
-    xx, yy, zz = xx_np(var1), yy_np(var1), zz_np(var1)
+        var1 = np.linspace(inter1[1], inter1[2], points)
+        xx, yy, zz = xx_np(var1), yy_np(var1), zz_np(var1)
 
-    l = list([xx, yy, zz])
-    for item in range(len(l)):
-        if type(item) != np.ndarray:
-            l[item] *= np.ones(var1.shape)
+        l = list([xx, yy, zz])
+        for item in range(len(l)):
+            if type(item) != np.ndarray:
+                l[item] *= np.ones(var1.shape)
 
-    xx, yy, zz = l[0], l[1], l[2]
+        xx, yy, zz = l[0], l[1], l[2]
 
     if fig is None:
 
@@ -512,12 +988,15 @@ def vector3d(x_0, y_0, z_0, x_1, y_1, z_1, ratio1 = 0.1, ratio2 = 1/3, fig=None,
     return fig
 
 #Plot a curve using its symbolic equation in the format f(x)
-def plot(func, inter1 = None, fig = None, xtitle = 'X', ytitle= 'Y', title=None, points = 50):
+def plot(func, inter1 = None, fig = None, xtitle = 'X', ytitle= 'Y', title=None, points = 50,
+         adaptive=False, angle=10, max_points=2000):
     
     '''
     - Argument:
         `func`: must be a function like y=f(x)
         `inter1`: (variable1, start, end)
+        `adaptive`: if True, the segments where the curve turns more than `angle` degrees are refined recursively,
+        starting from `points` uniform points and using at most `max_points` points. Non-finite values and jumps are drawn as breaks
     -Return:
         a Plotly graph object
     '''
@@ -535,10 +1014,14 @@ def plot(func, inter1 = None, fig = None, xtitle = 'X', ytitle= 'Y', title=None,
     
     assert func.free_symbols ==set([inter1[0]]), "The variable of the function isn't the same as the declared in the interval"
     
-    func_np = sp.lambdify(inter1[0], func)
+    func_np = cached_lambdify(inter1[0], func)
     
-    xx = np.linspace(inter1[1],inter1[2], points)
-    yy = func_np(xx)
+    if adaptive:
+        graph_np = lambda x: np.vstack([x, _evaluate(func_np, x)])
+        xx, (xx, yy) = _adaptive_sample(graph_np, inter1[1], inter1[2], points, angle, max_points)
+    else:
+        xx = np.linspace(inter1[1],inter1[2], points)
+        yy = func_np(xx)
     
     
        
@@ -598,7 +1081,7 @@ def plot3d(func, inter1=None, inter2=None, fig=None,
     
     
     
-    func_np = sp.lambdify(vars, func)
+    func_np = cached_lambdify(vars, func)
     
     points = eval(str(points) + 'j')
     xx, yy = np.mgrid[inter1[1]:inter1[2]:points, inter2[1]:inter2[2]:points]
@@ -662,21 +1145,12 @@ def plot3d_parametric_surface(func, inter1 = None, inter2 = None, fig = None, xt
     assert params_unique == set([inter1[0],inter2[0]]), "The parameters of the function aren't the same as the ones declared in the intervals"
     
     
-    xx_np = sp.lambdify([inter1[0],inter2[0]], func_x)
-    yy_np = sp.lambdify([inter1[0],inter2[0]], func_y)
-    zz_np = sp.lambdify([inter1[0],inter2[0]], func_z)
+    # the three coordinates are computed by one function. The constant coordinates are broadcast to the grid
+    surface_np = _fused_lambdify([inter1[0],inter2[0]], [func_x, func_y, func_z])
     
     var1,var2 = np.linspace(inter1[1],inter1[2],points), np.linspace(inter2[1],inter2[2],points)
     uGrid, vGrid = np.meshgrid(var1, var2)
-    xx, yy, zz = xx_np(uGrid,vGrid), yy_np(uGrid,vGrid), zz_np(uGrid,vGrid)
-    
-    # if one of the coordinate be constant. 
-    if isinstance(xx,int):
-        xx = xx*np.ones((points,points))
-    if isinstance(yy,int):
-        yy = yy*np.ones((points,points))
-    if isinstance(zz,int):
-        zz = zz*np.ones((points,points))
+    xx, yy, zz = surface_np(uGrid,vGrid)
     
     if surfacecolor:
         x_col = np.linspace(xx.min(), xx.max(), points)
@@ -686,7 +1160,7 @@ def plot3d_parametric_surface(func, inter1 = None, inter2 = None, fig = None, xt
         xx_col, yy_col, zz_col = np.meshgrid(x_col,y_col, z_col)
         
         vars = list(surfacecolor.free_symbols)
-        color_np = sp.lambdify(vars, surfacecolor) 
+        color_np = cached_lambdify(vars, surfacecolor) 
         for ind, var in enumerate(vars):
             if var.name == 'x':
                 vars[ind] = xx
@@ -730,7 +1204,7 @@ def plot_density_function(func, inter1 = None, inter2 = None, fig = None, xtitle
         func = sp.sympify(str(func))
     assert func.free_symbols ==set([inter1[0],inter2[0]]), "The variables of the function aren't the same as the declared in the intervals"
     
-    func_np = sp.lambdify([inter1[0],inter2[0]], func)
+    func_np = cached_lambdify([inter1[0],inter2[0]], func)
     
     points1 = eval(str(points) + 'j')
     
@@ -757,18 +1231,103 @@ def plot_density_function(func, inter1 = None, inter2 = None, fig = None, xtitle
     
     return fig
         
+# the six tetrahedra of a cube that share its main diagonal. The corner c of a cube is at (c & 1, c>>1 & 1, c>>2 & 1)
+_cube_tetrahedra = [(0, 1 << p, (1 << p) | (1 << q), 7) for p, q in [(0, 1), (1, 0), (0, 2), (2, 0), (1, 2), (2, 1)]]
+
+# isosurface extraction on a grid by marching tetrahedra (a variant of marching cubes without ambiguous cases)
+def _isosurface_mesh(values, xs, ys, zs, level):
+    '''
+    - Arguments:
+        `values`: an array of shape (n1, n2, n3) with the values of the function on the grid
+        `xs`, `ys`, `zs`: the coordinates of the grid along each axis
+        `level`: the value of the isosurface
+    - Return:
+        the vertices with the shape (k, 3) and the triangles with the shape (m, 3) as indices of the vertices.
+        The vertices shared by neighbouring triangles are stored only once.
+    '''
+    n1, n2, n3 = values.shape
+    flat = values.reshape(-1)
+    total = flat.size
+    axes = [np.asarray(xs, dtype=float), np.asarray(ys, dtype=float), np.asarray(zs, dtype=float)]
+
+    # only the cubes that are cut by the isosurface
+    corners = [(c & 1, (c >> 1) & 1, (c >> 2) & 1) for c in range(8)]
+    cube_values = np.array([values[dx:n1-1+dx, dy:n2-1+dy, dz:n3-1+dz] for dx, dy, dz in corners]).reshape(8, -1)
+    above = cube_values > level
+    cut = np.flatnonzero(above.any(axis=0) & ~above.all(axis=0))
+    ci, cj, ck = np.unravel_index(cut, (n1 - 1, n2 - 1, n3 - 1))
+    corner_index = np.array([((ci + dx)*n2 + cj + dy)*n3 + ck + dz for dx, dy, dz in corners])
+
+    def position(index):
+        i, j, k = np.unravel_index(index, values.shape)
+        return np.stack([axes[0][i], axes[1][j], axes[2][k]], axis=-1)
+
+    edges, directions = [], []
+    for tet in _cube_tetrahedra:
+        index = corner_index[list(tet)]
+        inside = flat[index] > level
+        count = inside.sum(axis=0)
+        order = np.argsort(~inside, axis=0, kind='stable')
+        sorted_index = np.take_along_axis(index, order, axis=0)
+
+        # one vertex on a side of the isosurface: one triangle around it
+        single = (count == 1) | (count == 3)
+        odd = np.where(count == 1, 0, 3)[single]
+        v = sorted_index[:, single]
+        odd_vertex = v[odd, np.arange(v.shape[1])]
+        others = np.array([v[np.where(odd == 0, s, s - 1), np.arange(v.shape[1])] for s in (1, 2, 3)])
+        edges.append(np.stack([np.stack([odd_vertex, o], axis=-1) for o in others], axis=1))
+        directions.append(np.where(count[single] == 1, 1, -1)[:, None]*(position(odd_vertex) - position(others).mean(axis=0)))
+
+        # two vertices on each side: a quadrilateral made of two triangles
+        double = count == 2
+        p, q, r, t = sorted_index[:, double]
+        quad = [np.stack([p, r], -1), np.stack([p, t], -1), np.stack([q, t], -1), np.stack([q, r], -1)]
+        direction = (position(p) + position(q) - position(r) - position(t))/2
+        edges.append(np.stack([quad[0], quad[1], quad[2]], axis=1))
+        edges.append(np.stack([quad[0], quad[2], quad[3]], axis=1))
+        directions += [direction, direction]
+
+    edges = np.concatenate(edges)
+    directions = np.concatenate(directions)
+    if len(edges) == 0:
+        return np.empty((0, 3)), np.empty((0, 3), dtype=int)
+
+    # each vertex lies on an edge of the grid, identified by its two end points
+    keys = np.sort(edges, axis=-1)
+    keys = keys[..., 0]*total + keys[..., 1]
+    unique_keys, faces = np.unique(keys, return_inverse=True)
+    faces = faces.reshape(-1, 3)
+    a, b = unique_keys // total, unique_keys % total
+    va, vb = flat[a].astype(float), flat[b].astype(float)
+    frac = (level - va)/(vb - va)
+    vertices = position(a) + frac[:, None]*(position(b) - position(a))
+
+    # the normals of the triangles point to the values larger than the level
+    normal = np.cross(vertices[faces[:, 1]] - vertices[faces[:, 0]], vertices[faces[:, 2]] - vertices[faces[:, 0]])
+    flip = np.sum(normal*directions, axis=1) < 0
+    faces[flip] = faces[flip][:, [0, 2, 1]]
+
+    return vertices, faces
+
 #3D Density Function (or Scalar Field) plot
         
 def plot3d_density_function(func, inter1 = None, inter2 = None, inter3 = None, 
                           fig = None, xtitle = 'X', ytitle= 'Y', ztitle = "Z", 
-                          title='2D Density Function', points = 50, isomin=0, isomax=20, opacity=0.4,surface_count=5):
+                          title='2D Density Function', points = 50, isomin=0, isomax=20, opacity=0.4,surface_count=5,
+                          dtype=np.float64, chunk=None, method='isosurface'):
     
     '''
     func: must be function with three variables
     inter1: (variable1, start, end)
     inter2: (variable2, start, end)
     inter3: (variable2, start, end)
+    dtype: the type of the arrays. np.float32 halves the memory
+    chunk: optional. the number of slabs along the first variable evaluated at once. The default keeps about 4 million points per slab
+    method: 'isosurface' sends the whole grid to plotly, 'mesh' extracts the surface_count isosurfaces between isomin and isomax
+            here and sends only their triangles (one mesh3d per isovalue)
     '''
+    assert method in ['isosurface', 'mesh'], "The method must be 'isosurface' or 'mesh'"
     
     if inter1 is None:
         print("Please input the interval for the first variable in the format (variable, begin, end)")
@@ -782,18 +1341,42 @@ def plot3d_density_function(func, inter1 = None, inter2 = None, inter3 = None,
         func = sp.sympify(str(func))
     assert func.free_symbols ==set([inter1[0],inter2[0],inter3[0]]), "The variables of the function aren't the same as the declared in the intervals"
     
-    func_np = sp.lambdify([inter1[0],inter2[0],inter3[0]], func)
-    
-    points1 = eval(str(points) + 'j')
-    
-    xx, yy, zz = np.mgrid[inter1[1]:inter1[2]:points1, inter2[1]:inter2[2]:points1, inter3[1]:inter3[2]:points1]
-    values = func_np(xx, yy, zz)
+    func_np = cached_lambdify([inter1[0],inter2[0],inter3[0]], func)
+    
+    # the coordinates and the values share one preallocated buffer, the same grid as np.mgrid
+    grid = np.empty((4, points, points, points), dtype=dtype)
+    grid[0] = np.linspace(inter1[1], inter1[2], points, dtype=dtype)[:, None, None]
+    grid[1] = np.linspace(inter2[1], inter2[2], points, dtype=dtype)[None, :, None]
+    grid[2] = np.linspace(inter3[1], inter3[2], points, dtype=dtype)[None, None, :]
+
+    # the function is evaluated slab by slab to bound the temporary arrays
+    if chunk is None:
+        chunk = max(1, 2**22 // points**2)
+    for i in range(0, points, chunk):
+        grid[3, i:i+chunk] = func_np(grid[0, i:i+chunk], grid[1, i:i+chunk], grid[2, i:i+chunk])
+    
+    if method == 'mesh':
+        if fig is None:
+            fig = go.Figure()
+        axes = grid[0, :, 0, 0], grid[1, 0, :, 0], grid[2, 0, 0, :]
+        for n, level in enumerate(np.linspace(isomin, isomax, surface_count)):
+            vertices, faces = _isosurface_mesh(grid[3], *axes, level)
+            if len(faces) == 0:
+                continue
+            fig.add_mesh3d(x=vertices[:, 0], y=vertices[:, 1], z=vertices[:, 2], i=faces[:, 0], j=faces[:, 1], k=faces[:, 2],
+                           intensity=np.full(len(vertices), level), cmin=isomin, cmax=isomax, colorscale='Plasma',
+                           opacity=opacity, showscale=n == 0, name=f'{level:.4g}', flatshading=False)
+        fig.update_layout(title=title, xaxis_title=xtitle, yaxis_title= ytitle)
+        return fig
+
+    # reshape of a contiguous buffer is a view, not a copy like flatten
+    xx, yy, zz, values = grid.reshape(4, -1)
     
     #x ,y = np.linspace(inter1[1],inter2[2],points), np.linspace(inter1[1],inter2[2],points)   
     
     if fig is None:
         fig = go.Figure()
-        fig.add_isosurface(x = xx.flatten(), y = yy.flatten(), z = zz.flatten(),value=values.flatten(),
+        fig.add_isosurface(x = xx, y = yy, z = zz,value=values,
         isomin=isomin,
         isomax=isomax,
         caps=dict(x_show=False, y_show=False),
@@ -805,7 +1388,7 @@ def plot3d_density_function(func, inter1 = None, inter2 = None, inter3 = None,
         
     
     else:
-        fig.add_isosurface(x = xx.flatten(), y = yy.flatten(), z = zz.flatten(),value=values.flatten(),
+        fig.add_isosurface(x = xx, y = yy, z = zz,value=values,
         isomin=isomin,
         isomax=isomax,
         caps=dict(x_show=False, y_show=False),
@@ -864,27 +1447,17 @@ def plot3d_vector_field(field, inter1=None, inter2=None, inter3 = None, fig = No
     xx,yy,zz = np.mgrid[inter1[1]:inter1[2]:num, inter2[1]:inter2[2]:num, inter3[1]:inter3[2]:num]     
     
     
-    field_x_np = sp.lambdify([var1,var2,var3], field_x)
-    field_y_np = sp.lambdify([var1,var2,var3], field_y)
-    field_z_np = sp.lambdify([var1,var2,var3], field_z)
+    # the three components are computed by one function that shares the common subexpressions
+    field_np = _fused_lambdify([var1,var2,var3], [field_x, field_y, field_z])
+    u, v, w = field_np(xx,yy,zz)
 
-
-    if isinstance(field_x, sp.core.numbers.Number):
-        u = np.ones(xx.shape)*float(field_x)
-    else:
-        u = field_x_np(xx,yy,zz)
+    if not isinstance(field_x, sp.core.numbers.Number):
         u = normalize(u)
     
-    if isinstance(field_y, sp.core.numbers.Number):
-        v = np.ones(yy.shape)*float(field_y)
-    else:
-        v = field_y_np(xx,yy,zz)
+    if not isinstance(field_y, sp.core.numbers.Number):
         v = normalize(v)
     
-    if isinstance(field_z, sp.core.numbers.Number):
-        w = np.ones(zz.shape)*float(field_z)
-    else:
-        w = field_z_np(xx,yy,zz)
+    if not isinstance(field_z, sp.core.numbers.Number):
         w = normalize(w)
 
     
@@ -937,20 +1510,343 @@ def plot_vector_field(func, inter1=None, inter2=None, fig = None, points=15, arr
     
     xx,yy = np.mgrid[inter1[1]:inter1[2]:num, inter2[1]:inter2[2]:num]        
 
-    func_np = sp.lambdify([var1,var2],func)
+    func_np = cached_lambdify([var1,var2],func)
 
     u,v = func_np(xx,yy)
         
     if fig is None:
-        fig = ff.create_quiver(xx, yy, u, v, arrow_scale=arrow_scale, name=name)
+        with _phase('figure'):
+            fig = ff.create_quiver(xx, yy, u, v, arrow_scale=arrow_scale, name=name)
         return fig
     
     else:
-        f = ff.create_quiver(xx, yy, u, v, arrow_scale=arrow_scale,name=name)
+        with _phase('figure'):
+            f = ff.create_quiver(xx, yy, u, v, arrow_scale=arrow_scale,name=name)
         fig.add_trace(*f.data)
         return fig   
 
 
+# the values of the parameters in each frame of an animation
+def _frame_grids(inter1, inter2, sweep, frames, points):
+    inter1 = (inter1[0], float(inter1[1]), float(inter1[2]))
+    if inter2 is not None:
+        inter2 = (inter2[0], float(inter2[1]), float(inter2[2]))
+    if sweep is not None:
+        sweep = (sweep[0], float(sweep[1]), float(sweep[2]))
+    # the swept value starts at its start value. The growing trace starts after it, as an empty trace isn't drawn
+    steps = np.linspace(0, 1, frames + 1)[1:] if sweep is None else np.linspace(0, 1, frames)
+    for value in steps:
+        if sweep is None:
+            # the trace grows along the first parameter with the same number of points in each frame
+            end = inter1[1] + (inter1[2] - inter1[1])*value
+            var1 = np.linspace(inter1[1], end, points)
+            extra = ()
+        else:
+            end = sweep[1] + (sweep[2] - sweep[1])*value
+            var1 = np.linspace(inter1[1], inter1[2], points)
+            extra = (end,)
+        if inter2 is None:
+            yield end, (var1,) + extra
+        else:
+            var2 = np.linspace(inter2[1], inter2[2], points)
+            uGrid, vGrid = np.meshgrid(var1, var2)
+            yield end, (uGrid, vGrid) + extra
+
+# frames of an animation of a parametric curve or surface
+def parametric_frames(func, inter1, inter2=None, sweep=None, frames=60, points=None, workers=None, window=None):
+    '''
+    - Arguments:
+        `func`: a tuple with three components or a vector of class sympy.vector. A curve if `inter2` is None, otherwise a surface
+        `inter1`: (parameter, start, end)
+        `inter2`: (parameter, start, end) for surfaces
+        `sweep`: None to draw the curve (or the surface along the first parameter) from start to a growing end,
+                 or (symbol, start, end) to vary an extra symbol of the equation from frame to frame
+        `frames`: the number of frames
+        `points`: the number of points along each parameter. 200 for curves and 50 for surfaces by default
+        `workers`: the number of threads evaluating the frames (numpy releases the GIL)
+        `window`: the maximum number of frames computed ahead of the consumer, twice the workers by default
+    - Return:
+        a generator of (value, xx, yy, zz). value is the end of the parameter or the value of the swept symbol.
+        The expression is compiled once and only `window` frames are in memory at the same time
+    '''
+    components = _components(func)
+    vars = [inter1[0]] if inter2 is None else [inter1[0], inter2[0]]
+    if sweep is not None:
+        vars.append(sweep[0])
+    params = set().union(*[f.free_symbols for f in components])
+    assert params <= set(vars), "The parameters of the function aren't the same as the ones declared in the intervals"
+    if points is None:
+        points = 200 if inter2 is None else 50
+
+    func_np = _fused_lambdify(vars, components)
+
+    def evaluate(task):
+        value, grids = task
+        return (value,) + tuple(func_np(*grids))
+
+    return _thread_imap(evaluate, _frame_grids(inter1, inter2, sweep, frames, points), workers, window)
+
+# animation of a parametric curve or surface
+def animate_parametric(func, inter1, inter2=None, sweep=None, frames=60, points=None, fig=None, 
+                       title='Animation', duration=50, ranges=None, writer=None, workers=None, window=None,
+                       line=None, showscale=False, scene_aspectmode='data'):
+    '''
+    - Arguments:
+        `func`, `inter1`, `inter2`, `sweep`, `frames`, `points`, `workers`, `window`: see parametric_frames
+        `fig`: A plotly figure object. Its traces stay fixed in all frames
+        `duration`: the duration of each frame in milliseconds
+        `ranges`: optional. [(xmin, xmax), (ymin, ymax), (zmin, zmax)] of the scene. By default they are found by a coarse pass
+        `writer`: optional. A callable writer(index, fig) or a file name pattern like 'frames/torus_{:03d}.png'.
+                  Each frame is drawn as a figure and written (with fig.write_image) as soon as it is computed
+    - Return:
+        a figure with the frames and a play button, or the number of frames written if `writer` is given
+
+    Example:
+    ========
+    >>> t, d = sp.symbols('t d')
+    >>> epitrochoid = (4*sp.cos(t) - d*sp.cos(4*t), 4*sp.sin(t) - d*sp.sin(4*t), 0)
+    >>> av.animate_parametric(epitrochoid, (t, 0, 2*sp.pi), sweep=(d, 0, 2))
+    '''
+    if fig is None:
+        fig = go.Figure()
+    fig = go.Figure(fig)
+    first_trace = len(fig.data)
+    if line is None:
+        line = dict(width=5)
+
+    def trace(xx, yy, zz):
+        if inter2 is None:
+            return go.Scatter3d(x=xx, y=yy, z=zz, mode='lines', line=line)
+        return go.Surface(x=xx, y=yy, z=zz, showscale=showscale)
+
+    if ranges is None:
+        # a coarse pass over all frames, so that the axes don't move during the animation
+        coarse = max(10, (points or (200 if inter2 is None else 50)) // 4)
+        low, high = np.full(3, np.inf), np.full(3, -np.inf)
+        for _, *xyz in parametric_frames(func, inter1, inter2, sweep, frames, coarse, workers, window):
+            for ind, item in enumerate(xyz):
+                if np.isfinite(item).any():
+                    low[ind] = min(low[ind], np.nanmin(item[np.isfinite(item)]))
+                    high[ind] = max(high[ind], np.nanmax(item[np.isfinite(item)]))
+        ranges = list(zip(low, high))
+    scene = dict(aspectmode=scene_aspectmode)
+    for name, (low, high) in zip('xyz', ranges):
+        pad = 0.05*(high - low) if high > low else 1
+        scene[name + 'axis'] = dict(range=[low - pad, high + pad], autorange=False)
+    fig.update_layout(title=title, scene=scene)
+
+    stream = parametric_frames(func, inter1, inter2, sweep, frames, points, workers, window)
+
+    if writer is not None:
+        if isinstance(writer, str):
+            pattern = writer
+            writer = lambda index, frame: frame.write_image(pattern.format(index))
+        count = 0
+        for index, (value, xx, yy, zz) in enumerate(stream):
+            frame = go.Figure(fig)
+            frame.add_trace(trace(xx, yy, zz))
+            frame.update_layout(title='{} ({:.4g})'.format(title, value))
+            writer(index, frame)
+            count += 1
+        return count
+
+    animation = []
+    for index, (value, xx, yy, zz) in enumerate(stream):
+        if index == 0:
+            fig.add_trace(trace(xx, yy, zz))
+        animation.append(go.Frame(data=[trace(xx, yy, zz)], traces=[first_trace], name=str(index)))
+    fig.frames = animation
+
+    play = dict(frame=dict(duration=duration, redraw=inter2 is not None), fromcurrent=True, transition=dict(duration=0))
+    fig.update_layout(updatemenus=[dict(type='buttons', showactive=False,
+                                        buttons=[dict(label='Play', method='animate', args=[None, play]),
+                                                 dict(label='Pause', method='animate',
+                                                      args=[[None], dict(frame=dict(duration=0, redraw=False), mode='immediate')])])])
+    return fig
+
+
+# the typed arrays understood by plotly.js, from the smallest to the largest
+_typed_array_ints = ['i1', 'u1', 'i2', 'u2', 'i4', 'u4']
+
+# base64 typed array of a numeric array, or None when the array can't be encoded
+def _typed_array(array, float32=True, rtol=1e-6, min_size=8):
+    '''
+    - Arguments:
+        `array`: a numpy array or a (nested) list
+        `float32`: downcast floats to float32 when the round trip error is below `rtol` times the range of the data
+        `min_size`: smaller arrays are kept as they are
+    - Return:
+        a dict with the keys dtype, bdata and shape (for 2D arrays) or None
+    '''
+    if isinstance(array, (list, tuple)):
+        if len(array) == 0 or any(item is None or isinstance(item, (str, bool, dict)) for item in array):
+            return None
+    try:
+        array = np.asarray(array)
+    except ValueError:
+        return None
+    if array.dtype.kind not in 'iuf' or array.size < min_size or array.ndim > 2:
+        return None
+
+    if array.dtype.kind in 'iu':
+        for code in _typed_array_ints:
+            info = np.iinfo(np.dtype(code))
+            if array.min() >= info.min and array.max() <= info.max:
+                array = array.astype(code)
+                break
+        else:
+            array = array.astype('f8')
+    else:
+        array = array.astype('f8')
+        if float32:
+            finite = array[np.isfinite(array)]
+            if finite.size == 0 or np.abs(finite).max() < np.finfo(np.float32).max:
+                small = array.astype('f4')
+                span = np.ptp(finite) if finite.size else 0
+                scale = span if span > 0 else (np.abs(finite).max() if finite.size else 0)
+                if np.all(np.abs(finite - finite.astype('f4')) <= rtol*scale):
+                    array = small
+
+    encoded = {'dtype': array.dtype.str[1:], 'bdata': base64.b64encode(np.ascontiguousarray(array).tobytes()).decode('ascii')}
+    if array.ndim == 2:
+        encoded['shape'] = '{}, {}'.format(*array.shape)
+    return encoded
+
+# plotly.js reads the base64 typed arrays (bdata) since the version 2.28. The older ones need plain lists
+def _bdata_supported():
+    major, minor = [int(n) for n in get_plotlyjs_version().split('.')[:2]]
+    return (major, minor) >= (2, 28)
+
+def _encode_arrays(obj, float32=True, rtol=1e-6, typed=True):
+    if isinstance(obj, dict) and 'bdata' in obj and 'dtype' in obj:
+        # already a typed array (plotly encodes the numpy arrays as float64)
+        array = np.frombuffer(base64.b64decode(obj['bdata']), dtype=obj['dtype'])
+        if 'shape' in obj:
+            array = array.reshape([int(n) for n in str(obj['shape']).split(',')])
+        if not typed:
+            return array.tolist()
+        return _typed_array(array, float32, rtol, min_size=0) or obj
+    if isinstance(obj, dict):
+        return {key: _encode_arrays(value, float32, rtol, typed) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple, np.ndarray)):
+        if typed:
+            encoded = _typed_array(obj, float32, rtol)
+            if encoded is not None:
+                return encoded
+        if isinstance(obj, np.ndarray):
+            return obj if typed else obj.tolist()
+        return [_encode_arrays(item, float32, rtol, typed) for item in obj]
+    return obj
+
+# serializing a figure with the data as base64 typed arrays
+def encode_figure(fig, float32=True, rtol=1e-6):
+    '''
+    - Arguments:
+        `fig`: a go.Figure (or its dict)
+        `float32`: store the floats as float32 where it doesn't change them more than `rtol` times the range of the data
+    - Return:
+        a dict with data, layout and frames. The numeric arrays of the traces are base64 typed arrays
+        (half the size of the text of float64 and a quarter with float32). If the plotly.js of the installed
+        plotly is older than 2.28, which can't read them, they are plain lists
+    '''
+    if isinstance(fig, go.Figure):
+        fig = fig.to_plotly_json()
+    typed = _bdata_supported()
+    encoded = {'data': [_encode_arrays(trace, float32, rtol, typed) for trace in fig.get('data', [])],
+               'layout': fig.get('layout', {})}
+    if fig.get('frames'):
+        encoded['frames'] = [dict(frame, data=[_encode_arrays(trace, float32, rtol, typed) for trace in frame.get('data', [])])
+                             for frame in fig['frames']]
+    return encoded
+
+# html of several figures that loads plotly.js only once
+def to_html(figs, include_plotlyjs='cdn', full_html=True, float32=True, rtol=1e-6, config=None, height='600px'):
+    '''
+    - Arguments:
+        `figs`: a figure or a list of figures
+        `include_plotlyjs`: 'cdn' for a script tag, True to embed plotly.js (offline pages), False if the page already has it,
+                            'guard' to load it from the cdn only if the page doesn't have it yet (notebooks, with or without RequireJS)
+        `full_html`: a complete page or only the div elements
+    - Return:
+        the html as a string
+    '''
+    if isinstance(figs, (go.Figure, dict)):
+        figs = [figs]
+    if config is None:
+        config = {'responsive': True}
+
+    cdn = 'https://cdn.plot.ly/plotly-{}.min'.format(get_plotlyjs_version())
+    parts = []
+    if include_plotlyjs == 'cdn':
+        parts.append('<script charset="utf-8" src="{}.js"></script>'.format(cdn))
+    elif include_plotlyjs and include_plotlyjs != 'guard':
+        parts.append('<script type="text/javascript">{}</script>'.format(get_plotlyjs()))
+
+    for fig in figs:
+        encoded = encode_figure(fig, float32, rtol)
+        div = 'av-{}'.format(uuid.uuid4().hex)
+        frames = to_json_plotly(encoded.get('frames', []))
+        draw = ('Plotly.newPlot("{div}", {data}, {layout}, {config}).then(function() {{\n'
+                '    if ({frames}.length) {{ Plotly.addFrames("{div}", {frames}); }}\n'
+                '}});').format(div=div, data=to_json_plotly(encoded['data']), layout=to_json_plotly(encoded['layout']),
+                               config=to_json_plotly(config), frames=frames)
+        if include_plotlyjs == 'guard':
+            draw = _plotlyjs_guard.format(cdn=cdn, draw=draw)
+        parts.append('<div id="{div}" style="height:{height}; width:100%;"></div>\n'
+                     '<script type="text/javascript">\n{draw}\n</script>'.format(div=div, height=height, draw=draw))
+
+    body = '\n'.join(parts)
+    if full_html:
+        return '<html>\n<head><meta charset="utf-8" /></head>\n<body>\n{}\n</body>\n</html>'.format(body)
+    return body
+
+# saving several figures in one html file
+def write_html(figs, file, include_plotlyjs='cdn', float32=True, rtol=1e-6, config=None, height='600px'):
+    '''
+    - Arguments:
+        `figs`: a figure or a list of figures
+        `file`: the path of the html file
+    - Return:
+        the size of the file in bytes
+    '''
+    html = to_html(figs, include_plotlyjs=include_plotlyjs, full_html=True, float32=float32, rtol=rtol,
+                   config=config, height=height)
+    with open(file, 'w', encoding='utf-8') as f:
+        f.write(html)
+    return len(html.encode('utf-8'))
+
+# drawing a figure once plotly.js is in the page. It is loaded only if no other output of the page loaded it.
+# With RequireJS (classic notebook) the bundle defines a module instead of window.Plotly
+_plotlyjs_guard = '''(function() {{
+    function draw() {{
+        {draw}
+    }}
+    if (window.Plotly) {{ draw(); return; }}
+    if (window.requirejs) {{
+        requirejs.config({{paths: {{plotly: "{cdn}"}}}});
+        requirejs(["plotly"], function(Plotly) {{ window.Plotly = Plotly; draw(); }});
+        return;
+    }}
+    var script = document.getElementById("av-plotlyjs");
+    if (!script) {{
+        script = document.createElement("script");
+        script.id = "av-plotlyjs";
+        script.src = "{cdn}.js";
+        document.head.appendChild(script);
+    }}
+    script.addEventListener("load", draw);
+}})();'''
+
+# displaying a figure in the notebook with typed arrays
+def show(fig, float32=True, rtol=1e-6, height='600px'):
+    '''
+    Same as fig.show() in a notebook, but the data is sent as typed arrays. plotly.js is loaded from the cdn
+    only when the page doesn't have it, so the figures still show after reloading the page or clearing outputs.
+    '''
+    from IPython.display import HTML, display
+    display(HTML(to_html(fig, include_plotlyjs='guard', full_html=False, float32=float32, rtol=rtol, height=height)))
+
+
 #normalizing an array
 def normalize(array):
     return (array - np.mean(array))/(np.max(array)-np.min(array))
@@ -994,17 +1890,171 @@ def plane_1(a,b,c):
 
 # Norm of a vector
 def Norm(v):
-    return sp.simplify(sp.sqrt(v.dot(v)))
+    with _phase('simplify'):
+        return sp.simplify(sp.sqrt(v.dot(v)))
 
 #Unit vector
 def Unit_Vector(curve):
     return curve/Norm(curve)
 
 #Arc Length
-def Arc_Length(curve, a): 
+def Arc_Length(curve, a, method='symbolic'): 
     #a: Um Tuple (variavel, inicio, fim)
+    #method: 'symbolic' usa sp.integrate, 'numeric' usa a tabela de ArcLengthTable (curvas sem primitiva, como a elipse)
+    assert method in ('symbolic', 'numeric'), "method must be 'symbolic' or 'numeric'"
+    if method == 'numeric':
+        return ArcLengthTable(curve, a).length
+
+    module = Norm(curve.diff(a[0]))
+    with _phase('integrate'):
+        return sp.integrate(module,a)
+
+# cubic Hermite interpolation of the values y with the derivatives dy at the increasing nodes x
+def _hermite(x, y, dy, points):
+    k = np.clip(np.searchsorted(x, points, side='right') - 1, 0, len(x) - 2)
+    h = x[k+1] - x[k]
+    u = (points - x[k])/h
+    return ((2*u**3 - 3*u**2 + 1)*y[k] + (u**3 - 2*u**2 + u)*h*dy[k]
+            + (-2*u**3 + 3*u**2)*y[k+1] + (u**3 - u**2)*h*dy[k+1])
+
+# cumulative arc length of a curve and the reparametrization by the arc length
+class ArcLengthTable:
+    '''
+    - Arguments:
+        `curve`: a parametric curve of class sympy.vector or a tuple with three components
+        `a`: (parameter, start, end)
+        `panels`: the number of panels of the table
+        `nodes`: the number of Gauss-Legendre nodes in each panel
+    - Attributes:
+        `t`, `s`: the parameter and the arc length from the start at the ends of the panels
+        `length`: the length of the curve
+    The speed |r'(t)| is compiled once and evaluated on all the panels in one call. Between the nodes of the table
+    s(t) and t(s) are cubic Hermite interpolations, since ds/dt = |r'(t)|.
 
-    return sp.integrate(Norm(curve.diff(a[0])),a)
+    Example:
+    ========
+    >>> table = av.ArcLengthTable((2*sp.cos(t), sp.sin(t), 0), (t, 0, 2*sp.pi))
+    >>> table.length
+    9.688448220547...
+    >>> t_uniform = table.uniform(20) # 20 points with the same distance along the ellipse
+    '''
+    def __init__(self, curve, a, panels=256, nodes=8):
+        components = _components(curve)
+        self.param = a[0]
+        assert set().union(*[f.free_symbols for f in components]) <= {self.param}, "A curve has only one parameter"
+        velocity_np = _fused_lambdify(self.param, [f.diff(self.param) for f in components])
+        self._speed = lambda t: np.sqrt(np.sum(velocity_np(t)**2, axis=0))
+
+        start, end = float(a[1]), float(a[2])
+        self.t = np.linspace(start, end, panels + 1)
+        x_gl, w_gl = np.polynomial.legendre.leggauss(nodes)
+        half = np.diff(self.t)/2
+        t_nodes = (self.t[:-1] + half)[:, None] + half[:, None]*x_gl
+        panel_length = half*(self._speed(t_nodes) @ w_gl)
+        self.s = np.concatenate([[0], np.cumsum(panel_length)])
+        self.length = float(self.s[-1])
+        self._ds = self._speed(self.t)
+
+    def to_length(self, t):
+        '''the arc length from the start of the curve to the parameter t'''
+        return _hermite(self.t, self.s, self._ds, np.asarray(t, dtype=float))
+
+    def to_param(self, s, newton=2):
+        '''the parameter t of the point with the arc length s. `newton` steps refine the interpolation'''
+        s = np.clip(np.asarray(s, dtype=float), 0, self.length)
+        # dt/ds = 1/|r'(t)|. The points where the speed is zero use the secant of the panel
+        secant = np.diff(self.t)/np.maximum(np.diff(self.s), np.finfo(float).tiny)
+        slope = np.empty_like(self._ds)
+        slope[:-1], slope[-1] = secant, secant[-1]
+        moving = self._ds > 1e-12*np.max(self._ds)
+        slope[moving] = 1/self._ds[moving]
+        t = _hermite(self.s, self.t, slope, s)
+        for _ in range(newton):
+            speed = self._speed(t)
+            step = np.where(speed > 0, (self.to_length(t) - s)/np.where(speed > 0, speed, 1), 0)
+            t = np.clip(t - step, self.t[0], self.t[-1])
+        return t
+
+    def uniform(self, n):
+        '''n values of the parameter equally spaced along the curve, including both ends'''
+        return self.to_param(np.linspace(0, self.length, n))
+
+# Frenet-Serret frame of a curve. The derivatives and the vectors are computed only once, when they are used for the first time
+class FrenetFrame:
+    '''
+    - Arguments:
+        `curve`: a parametric curve r(t) of class sympy.vector
+        `param`: the parameter of the curve. `t` by default
+    - Attributes (computed lazily and cached):
+        `d1`, `d2`, `d3`: the first, second and third derivatives of r(t)
+        `speed`: |r'(t)|
+        `T`, `N`, `B`: the unit tangent, normal and binormal vectors
+        `curvature`: |r' x r''|/|r'|^3
+        `torsion`: (r' x r'').d3/|r' x r''|^2
+
+    Example:
+    ========
+    >>> frame = av.FrenetFrame(sp.cos(t)*R.i + sp.sin(t)*R.j + t*R.k, t)
+    >>> frame.curvature, frame.torsion
+    (1/2, 1/2)
+    '''
+    def __init__(self, curve, param=None):
+        self.curve = curve
+        self.param = sp.symbols('t') if param is None else param
+
+    @cached_property
+    def d1(self):
+        return self.curve.diff(self.param)
+
+    @cached_property
+    def d2(self):
+        return self.d1.diff(self.param)
+
+    @cached_property
+    def d3(self):
+        return self.d2.diff(self.param)
+
+    @cached_property
+    def speed(self):
+        return Norm(self.d1)
+
+    # r' x r'' is parallel to the binormal vector. N and B don't need the derivative of T
+    @cached_property
+    def _cross(self):
+        return self.d1.cross(self.d2)
+
+    @cached_property
+    def _cross_norm(self):
+        return Norm(self._cross)
+
+    @cached_property
+    def T(self):
+        return self.d1/self.speed
+
+    @cached_property
+    def B(self):
+        with _phase('simplify'):
+            return (self._cross/self._cross_norm).simplify()
+
+    @cached_property
+    def N(self):
+        with _phase('simplify'):
+            return (self.B.cross(self.T)).simplify()
+
+    @cached_property
+    def curvature(self):
+        with _phase('simplify'):
+            return sp.simplify(self._cross_norm/self.speed**3)
+
+    @cached_property
+    def torsion(self):
+        with _phase('simplify'):
+            return sp.simplify(self._cross.dot(self.d3)/self._cross_norm**2)
+
+# the frames are shared by UT, UN, UB, curvature and torsion
+@lru_cache(maxsize=64)
+def _frenet_frame(curve, param):
+    return FrenetFrame(curve, param)
 
 # Tangent Unitary vector
 def UT(curve, param=None): 
@@ -1012,7 +2062,7 @@ def UT(curve, param=None):
         t = sp.symbols('t')
     else:
         t = param
-    return curve.diff(t)/Norm(curve.diff(t))
+    return _frenet_frame(curve, t).T
 
 # Normal Unitary Vector
 def UN(curve, param=None): 
@@ -1020,10 +2070,15 @@ def UN(curve, param=None):
         t = sp.symbols('t')
     else:
         t = param
-    return (UT(curve).diff(t)/Norm(UT(curve).diff(t))).simplify()
+    return _frenet_frame(curve, t).N
 
 # Binormal Unitary Vector
-def UB(curve): return (UT(curve)^UN(curve)).simplify()
+def UB(curve, param=None): 
+    if param is None:
+        t = sp.symbols('t')
+    else:
+        t = param
+    return _frenet_frame(curve, t).B
 
 # Curvature of a curve
 def curvature(curve, param=None, point=None): 
@@ -1033,9 +2088,9 @@ def curvature(curve, param=None, point=None):
         t = param
     
     if point is None:
-        return ((UT(curve).diff(t).magnitude())/(curve.diff(t).magnitude()))
+        return _frenet_frame(curve, t).curvature
     else:
-        return ((UT(curve).diff(t).magnitude())/(curve.diff(t).magnitude())).subs(t, point)
+        return _frenet_frame(curve, t).curvature.subs(t, point)
 
 # Torsion of a curve
 def torsion(curve , param=None): 
@@ -1046,7 +2101,98 @@ def torsion(curve , param=None):
     else:
         t = param
 
-    return ((curve.diff(t).cross(curve.diff(t,2))).dot(curve.diff(t,3))/Norm(curve.diff(t).cross(curve.diff(t,2))))
+    return _frenet_frame(curve, t).torsion
+
+# Frenet-Serret frames of a curve evaluated numerically on the samples of its parameter
+def frenet_samples(curve, inter, points=1000):
+    '''
+    - Arguments:
+        `curve`: a parametric curve of class sympy.vector or a tuple with three components
+        `inter`: (parameter, start, end), or (parameter, array) with the values of the parameter
+        `points`: the number of samples between start and end
+    - Return:
+        a dict with the arrays `t` (n,), `position`, `T`, `N`, `B` (n,3), `curvature` and `torsion` (n,).
+        r(t) and its first three derivatives are compiled once in one function with common subexpressions.
+        Where the curvature is zero the frame of the previous sample is used (or of the next one at the beginning)
+    '''
+    components = _components(curve)
+    param = inter[0]
+    assert set().union(*[f.free_symbols for f in components]) <= {param}, "A curve has only one parameter"
+    if len(inter) == 2:
+        t = np.asarray(inter[1], dtype=float)
+    else:
+        t = np.linspace(float(inter[1]), float(inter[2]), points)
+
+    derivatives = [f.diff(param, order) for order in range(4) for f in components]
+    values = _fused_lambdify(param, derivatives)(t).reshape(4, 3, -1).transpose(0, 2, 1)
+    position, d1, d2, d3 = values
+
+    speed = np.linalg.norm(d1, axis=1)
+    cross = np.cross(d1, d2)
+    cross_norm = np.linalg.norm(cross, axis=1)
+    T = d1/speed[:, None]
+
+    # r' x r'' vanishes where the curve is straight. The binormal is taken from the nearest sample before it
+    valid = cross_norm > 1e-12*speed**2
+    B = np.zeros_like(cross)
+    B[valid] = cross[valid]/cross_norm[valid, None]
+    if valid.any():
+        index = np.maximum.accumulate(np.where(valid, np.arange(len(t)), -1))
+        index[index < 0] = np.argmax(valid)
+        B = B[index]
+        # the copied binormal is made perpendicular to the local tangent
+        B -= np.sum(B*T, axis=1)[:, None]*T
+        B /= np.linalg.norm(B, axis=1)[:, None]
+    else:
+        # a straight line: any vector perpendicular to the tangent
+        axis = np.eye(3)[np.argmin(np.abs(T[0]))]
+        B = np.cross(T, axis)
+        B /= np.linalg.norm(B, axis=1)[:, None]
+    N = np.cross(B, T)
+
+    curvature = cross_norm/speed**3
+    torsion = np.zeros_like(speed)
+    torsion[valid] = np.sum(cross[valid]*d3[valid], axis=1)/cross_norm[valid]**2
+
+    return {'t': t, 'position': position, 'T': T, 'N': N, 'B': B, 'curvature': curvature, 'torsion': torsion}
+
+# a tube (or a ribbon) around a curve, built on its Frenet frames
+def plot3d_tube(curve, inter, radius=0.1, points=400, sides=16, shape='tube', color=None, fig=None,
+                title='3D Tube', colorscale='Viridis', showscale=True, scene_aspectmode='data'):
+    '''
+    - Arguments:
+        `curve`: a parametric curve of class sympy.vector or a tuple with three components
+        `inter`: (parameter, start, end)
+        `radius`: the radius of the tube or the half width of the ribbon
+        `points`: the number of samples along the curve
+        `sides`: the number of points around the tube
+        `shape`: 'tube' or 'ribbon'. The ribbon lies along the binormal vector
+        `color`: None, 'curvature', 'torsion' or 't' to color the surface
+    - Return:
+        A figure object of Plotly
+    '''
+    assert shape in ['tube', 'ribbon'], "The shape must be 'tube' or 'ribbon'"
+    frames = frenet_samples(curve, inter, points)
+    position, N, B = frames['position'], frames['N'], frames['B']
+
+    if shape == 'tube':
+        theta = np.linspace(0, 2*np.pi, sides)
+        offset = radius*(np.cos(theta)[:, None, None]*N + np.sin(theta)[:, None, None]*B)
+    else:
+        offset = np.linspace(-radius, radius, 2)[:, None, None]*B
+    surface = position + offset
+    xx, yy, zz = surface[..., 0], surface[..., 1], surface[..., 2]
+
+    surfacecolor = None
+    if color is not None:
+        surfacecolor = np.broadcast_to(frames[color], xx.shape)
+
+    if fig is None:
+        fig = go.Figure()
+    fig.add_surface(x=xx, y=yy, z=zz, surfacecolor=surfacecolor, colorscale=colorscale,
+                    showscale=showscale and color is not None)
+    fig.update_layout(title=title, scene_aspectmode=scene_aspectmode)
+    return fig
 
 #Integral of a parametric curve accepting the boundary condition to determine the constant of integration
 def integral_curve(curve,var, ics=None):
@@ -1075,9 +2221,10 @@ def integral_curve(curve,var, ics=None):
     x_c = curve.dot(R.i)
     y_c = curve.dot(R.j)
     z_c = curve.dot(R.k)
-    x_c_int = sp.integrate(x_c,var)
-    y_c_int = sp.integrate(y_c,var)
-    z_c_int = sp.integrate(z_c,var)
+    with _phase('integrate'):
+        x_c_int = sp.integrate(x_c,var)
+        y_c_int = sp.integrate(y_c,var)
+        z_c_int = sp.integrate(z_c,var)
     v_int = (x_c_int+c_1)*R.i + (y_c_int + c_2)*R.j + (z_c_int + c_3)*R.k
     
     if ics is not None:
@@ -1097,16 +2244,110 @@ def integral_curve(curve,var, ics=None):
 
         return v_int
 
+# Nodes and weights of the 7-point Gauss and 15-point Kronrod rules on [-1,1] (the same as QUADPACK)
+_kronrod_nodes = np.array([0.991455371120812639206854697526329, 0.949107912342758524526189684047851,
+                           0.864864423359769072789712788640926, 0.741531185599394439863864773280788,
+                           0.586087235467691130294144845693013, 0.405845151377397166906606412076961,
+                           0.207784955007898467600689403773245, 0.000000000000000000000000000000000])
+_kronrod_weights = np.array([0.022935322010529224963732008058970, 0.063092092629978553290700663189204,
+                             0.104790010322250183839876322541518, 0.140653259715525918745189590510238,
+                             0.169004726639267902826583426598550, 0.190350578064785409913256402421014,
+                             0.204432940075298892414161999234649, 0.209482141084727828012999174891714])
+_gauss7_weights = np.array([0.129484966168869693270611432679082, 0.279705391489276667901467771423780,
+                            0.381830050505118944950369775488975, 0.417959183673469387755102040816327])
+
+_kronrod_nodes = np.concatenate([-_kronrod_nodes[:-1], _kronrod_nodes[::-1]])
+_kronrod_weights = np.concatenate([_kronrod_weights[:-1], _kronrod_weights[::-1]])
+# the Gauss nodes are the odd positions of the Kronrod nodes
+_gauss7_weights = np.concatenate([_gauss7_weights[:-1], _gauss7_weights[::-1]])
+
+# evaluating a lambdified function and broadcasting the result, because a constant expression returns a number
+def _evaluate(func_np, *args):
+    shape = np.broadcast(*args).shape
+    return np.broadcast_to(np.asarray(func_np(*args), dtype=float), shape)
+
+# Gauss-Legendre quadrature of a vectorized function with a fixed number of nodes
+def _gauss_legendre(func_np, a, b, nodes=32):
+    '''
+    - Arguments:
+        `func_np`: a vectorized function of one variable
+        `a`, `b`: the endpoints of the interval
+        `nodes`: the number of nodes of the rule
+    - Return:
+        the integral and an estimation of its error, the difference with the rule with half of the nodes
+    '''
+    a, b = float(a), float(b)
+    c, h = (a + b)/2, (b - a)/2
+    x, w = np.polynomial.legendre.leggauss(nodes)
+    x_half, w_half = np.polynomial.legendre.leggauss(max(nodes//2, 1))
+    value = h*np.sum(w*_evaluate(func_np, c + h*x))
+    value_half = h*np.sum(w_half*_evaluate(func_np, c + h*x_half))
+    return value, abs(value - value_half)
+
+# adaptive Gauss-Kronrod quadrature. All the subintervals of a level are evaluated in one call of the function
+def _gauss_kronrod(func_np, a, b, tol=1e-10, rtol=1e-10, limit=50, max_intervals=2000):
+    '''
+    - Arguments:
+        `func_np`: a vectorized function of one variable
+        `a`, `b`: the endpoints of the interval
+        `tol`, `rtol`: the absolute and relative tolerances. The target error is max(tol, rtol*|integral|)
+        `limit`: the maximum number of bisections of the interval
+        `max_intervals`: the maximum number of subintervals, like the `limit` of QUADPACK. When it is reached
+        the current value is returned with its error estimation and a warning
+    - Return:
+        the integral and an estimation of its error
+    '''
+    a, b = float(a), float(b)
+    if a == b:
+        return 0.0, 0.0
+    left, right = np.array([a]), np.array([b])
+    value, error, accepted = 0.0, 0.0, 0
+    for level in range(limit):
+        c, h = (left + right)/2, (right - left)/2
+        f = _evaluate(func_np, c[:, None] + h[:, None]*_kronrod_nodes)
+        kronrod = h*(f @ _kronrod_weights)
+        gauss = h*(f[:, 1::2] @ _gauss7_weights)
+        err = np.abs(kronrod - gauss)
+
+        target = max(tol, rtol*abs(value + kronrod.sum()))
+        if error + err.sum() <= target:
+            # the whole estimation is already good enough
+            done = np.ones(len(err), dtype=bool)
+        else:
+            # each subinterval must satisfy its share of the tolerance
+            done = err <= target*np.abs(right - left)/abs(b - a)
+        pending = len(err) - done.sum()
+        if pending and (level == limit - 1 or accepted + len(err) + pending > max_intervals):
+            print(f"the quadrature stopped at {accepted + len(err)} subintervals with the estimated error "
+                  f"{error + err.sum():.3g}, larger than the tolerance {target:.3g}")
+            done[:] = True
+        value += kronrod[done].sum()
+        error += err[done].sum()
+        accepted += done.sum()
+        if done.all():
+            break
+        left, right, c = left[~done], right[~done], c[~done]
+        left, right = np.concatenate([left, c]), np.concatenate([c, right])
+
+    return value, error
+
 #Line Integral for a scalar field
-def line_integral_scalar(field,curve,a):
+def line_integral_scalar(field,curve,a, method='symbolic', tol=1e-10, rtol=1e-10, nodes=None, workers=1, timeout=None):
     '''
     - Arguments:
         `field`: Scalar field F(x,y,z). 
         `curve`: one or a list of parametrized curve r(t) = x(t)i + y(t)j + z(t)k
         `a`: a tuple or a list of tuples each one as (parameter of the curve, initial point, final point
         Note: if the field is tridimensional, the curve also must have the same dimension. 
+        `method`: 'symbolic' (default) uses `sp.integrate`. 'numeric' lambdifies the integrand once
+        and integrates it with an adaptive Gauss-Kronrod quadrature
+        `tol`, `rtol`: the absolute and relative tolerances of the numeric method for each curve
+        `nodes`: optional. the number of nodes of a fixed Gauss-Legendre rule used instead of the adaptive quadrature
+        `workers`: the number of processes integrating the curves in the 'symbolic' method. None uses all the CPUs
+        `timeout`: optional. the maximum time in seconds to wait for the integral of each curve
     - Return:
         line integral of the scalar filed along the curve(s) for the given interval(s). 
+        In the 'numeric' method, a tuple with the integral and an estimation of its error.
 
     ===================
     Example:
@@ -1118,7 +2359,10 @@ def line_integral_scalar(field,curve,a):
         l = av.lines([(1,2,3), (3,4,5),(5,6,7)])
         av.line_integral_scalar(z, curve=l, a=(t,0,3)) # one interval for all curves
         av.line_integral_scalar(z, curve=l, a=((t,0,3),(t,0,1))) #one interval for each curve
+        av.line_integral_scalar(z, curve=l, a=(t,0,3), method='numeric')
+        av.line_integral_scalar(z, curve=l, a=(t,0,3), workers=3) # one process for each curve
     '''    
+    assert method in ('symbolic', 'numeric'), "method must be 'symbolic' or 'numeric'"
 
     if isinstance(curve, Iterable):
         if not isinstance(a[0], Iterable):
@@ -1136,6 +2380,8 @@ def line_integral_scalar(field,curve,a):
     param_field = [p for p in field.free_symbols if not p.is_Vector]
 
     integral = 0
+    error = 0
+    tasks = []
     for item,var in zip(curve,a):
         field_tmp = field
         param_curve = [p for p in item.free_symbols if not p.is_Vector]
@@ -1153,24 +2399,44 @@ def line_integral_scalar(field,curve,a):
             elif par.name == 'z':
                 field_tmp = field_tmp.subs(par, rz)      
 
-        module = item.diff().magnitude().simplify()
-            
-    
-        integrand = (field_tmp*module).simplify()
-        integral += sp.integrate(integrand,(param_curve[0], var[1],var[2])).evalf()
+        if method == 'numeric':
+            # no simplification here. The integrand is compiled as it is and integrated numerically
+            integrand = field_tmp*item.diff(param_curve[0]).magnitude()
+            integrand_np = cached_lambdify(param_curve[0], integrand, 'numpy')
+            if nodes is None:
+                value, err = _gauss_kronrod(integrand_np, var[1], var[2], tol=tol, rtol=rtol)
+            else:
+                value, err = _gauss_legendre(integrand_np, var[1], var[2], nodes=nodes)
+            integral += value
+            error += err
+            continue
+
+        # the simplification and the integration are done by _line_segment_integral, maybe in another process
+        tasks.append((field_tmp, item.diff().magnitude(), (param_curve[0], var[1], var[2])))
         
+    if method == 'numeric':
+        return float(integral), float(error)
+
+    for value in _integrate_segments(tasks, workers, timeout):
+        integral += value
     return integral
 
 #Line integral for a vectorial field
-def line_integral_vectorial(field,curve,a):
+def line_integral_vectorial(field,curve,a, method='symbolic', nodes=32, workers=1, timeout=None):
     '''
     - Arguments:
         `field`: Vector field F(x,y,z) = P(x,y,z)i + R(x,y,z)j + Q(x,y,z)k. The parameters of the field must be `x`,`y` and `z`
         `curve`: one or a list of parametrized curves as r(t) = x(t)i + y(t)j + z(t)k
         `a`: one or a list of tuples each one as (parameter of the curve, initial point, final point)
         **Note**: the dimensionality of curve and field must be the same. 
+        `method`: 'symbolic' (default) integrates each curve with `sp.integrate`. 'numeric' evaluates
+        F(r(t)).r'(t) of all the curves in one NumPy call on a shared Gauss-Legendre grid
+        `nodes`: the number of Gauss-Legendre nodes per curve in the 'numeric' method
+        `workers`: the number of processes integrating the curves in the 'symbolic' method. None uses all the CPUs
+        `timeout`: optional. the maximum time in seconds to wait for the integral of each curve
     - Return:
         line integral of the vectorial filed along the curve(s) for the given interval(s). 
+        In the 'numeric' method, a tuple with the integral and an array with the contribution of each curve.
 
 
     Example:
@@ -1187,8 +2453,10 @@ def line_integral_vectorial(field,curve,a):
     
     av.line_integral_vectorial(f(x,y,z), l, (t,-1,2)) # one interval for all curves
     av.line_integral_vectorial(f(x,y,z), l, ((t,-1,2),(t,0,2))) # one interval for each curve
+    av.line_integral_vectorial(f(x,y,z), l, (t,-1,2), method='numeric')
     
     '''
+    assert method in ('symbolic', 'numeric'), "method must be 'symbolic' or 'numeric'"
 
     if isinstance(curve, Iterable):
         if not isinstance(a[0], Iterable):
@@ -1207,7 +2475,11 @@ def line_integral_vectorial(field,curve,a):
     #getting the parameters of the field
     param_field = [p for p in field.free_symbols if not p.is_Vector]
 
+    if method == 'numeric':
+        return _line_integral_vectorial_numeric(field, curve, a, R, param_field, nodes)
+
     integral = 0
+    tasks = []
     for item,var in zip(curve,a):
         field_tmp = field
     
@@ -1230,20 +2502,493 @@ def line_integral_vectorial(field,curve,a):
                 field_tmp = field_tmp.subs(par, z_c)        
         
         integrand = field_tmp.dot(item.diff())
-        integral += sp.integrate(integrand,(param_curve[0], var[1],var[2])).evalf()
+        tasks.append((integrand, None, (param_curve[0], var[1], var[2])))
     
+    for value in _integrate_segments(tasks, workers, timeout):
+        integral += value
     return integral
 
+# the symbolic integral of one curve. `module` is the norm of r'(t) for the scalar line integrals
+def _line_segment_integral(task):
+    integrand, module, limits = task
+    if module is not None:
+        with _phase('simplify'):
+            integrand = (integrand*module.simplify()).simplify()
+    with _phase('integrate'):
+        return sp.integrate(integrand, limits).evalf()
+
+# the integrals of the curves in their original order, in parallel if workers > 1
+def _integrate_segments(tasks, workers=1, timeout=None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(tasks)))
+    # a timeout needs the pool even with one worker: the integral of a process can be stopped, not of this one
+    if workers == 1 and timeout is None:
+        return [_line_segment_integral(task) for task in tasks]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = [pool.apply_async(_line_segment_integral, (task,)) for task in tasks]
+        values = []
+        for ind, result in enumerate(results):
+            try:
+                values.append(result.get(timeout))
+            except multiprocessing.TimeoutError:
+                raise multiprocessing.TimeoutError(f"the integral of the curve {ind} took more than {timeout} seconds") from None
+        pool.close()
+        return values
+    finally:
+        # terminate also stops the integrals still running after a timeout
+        pool.terminate()
+        pool.join()
+
+# the numeric engine of line_integral_vectorial. All the curves are evaluated on a shared quadrature grid
+def _line_integral_vectorial_numeric(field, curve, a, R, param_field, nodes):
+    # the field is compiled once as a function of (x, y, z)
+    xyz = []
+    for name in ('x', 'y', 'z'):
+        par = [p for p in param_field if p.name == name]
+        xyz.append(par[0] if par else sp.symbols(name))
+    field_np = cached_lambdify(xyz, [field & R.i, field & R.j, field & R.k], 'numpy')
+
+    x_gl, w_gl = np.polynomial.legendre.leggauss(nodes)
+    n = len(curve)
+    position = np.empty((n, nodes, 3))
+    velocity = np.empty((n, nodes, 3))
+    half = np.empty(n)
+
+    for ind, (item, var) in enumerate(zip(curve, a)):
+        param_curve = [p for p in item.free_symbols if not p.is_Vector]
+        assert len(param_curve)==1, "A curve has only one parameter"
+        assert param_curve[0].name == var[0].name, "the parameter of the curve must be the same as the integration variable."
+        t = param_curve[0]
+
+        start, end = float(var[1]), float(var[2])
+        half[ind] = (end - start)/2
+        t_nodes = (start + end)/2 + half[ind]*x_gl
+        components = [item.dot(R.i), item.dot(R.j), item.dot(R.k)]
+
+        # the segments made by `lines` are affine, r(t) = r0 + d*t, and don't need to be compiled
+        coeffs = [c.as_independent(t, as_Add=True) for c in components]
+        coeffs = [(r0, d/t) for r0, d in coeffs]
+        affine = not any(d.has(t) for r0, d in coeffs)
+
+        if affine:
+            coeffs = np.array(coeffs, dtype=float)
+            position[ind] = coeffs[:, 0] + t_nodes[:, None]*coeffs[:, 1]
+            velocity[ind] = coeffs[:, 1]
+        else:
+            curve_np = cached_lambdify(t, components + [c.diff(t) for c in components], 'numpy')
+            values = [np.broadcast_to(np.asarray(v, dtype=float), t_nodes.shape) for v in curve_np(t_nodes)]
+            position[ind] = np.stack(values[:3], axis=-1)
+            velocity[ind] = np.stack(values[3:], axis=-1)
+
+    # one evaluation of the field on the points of all the curves
+    field_values = field_np(position[..., 0], position[..., 1], position[..., 2])
+    integrand = sum(np.broadcast_to(np.asarray(f, dtype=float), position.shape[:2])*velocity[..., k]
+                    for k, f in enumerate(field_values))
+    contributions = half*(integrand @ w_gl)
+
+    return float(contributions.sum()), contributions
+
+# the three components of a vector of sympy.vector or of a tuple/list with three elements
+def _components(func):
+    if isinstance(func, sp.Expr) and func.is_Vector:
+        R = list(func.separate().keys())[0]
+        return func & R.i, func & R.j, func & R.k
+    assert isinstance(func, (tuple, list)) and len(func)==3, "the surface must be a tuple of three sympy functions or a vector of class sympy.vector"
+    return tuple(sp.sympify(f) for f in func)
+
+# replacing the variables x, y and z of a field by the components of a parametrization
+def _parametrize(field, components):
+    params = [p for p in field.free_symbols if not p.is_Vector]
+    # simultaneous, as the components may contain x, y or z themselves (a surface parametrized by x and y)
+    mapping = {par: components['xyz'.index(par.name)] for par in params if par.name in ('x', 'y', 'z')}
+    return field.subs(mapping, simultaneous=True)
+
+# tensor-product Gauss-Legendre quadrature of a vectorized function of several variables
+def _tensor_gauss(func_np, intervals, nodes):
+    grids, weights = [], []
+    for start, end in intervals:
+        x, w = np.polynomial.legendre.leggauss(nodes)
+        c, h = (float(start) + float(end))/2, (float(end) - float(start))/2
+        grids.append(c + h*x)
+        weights.append(h*w)
+    mesh = np.meshgrid(*grids, indexing='ij', sparse=True)
+    values = _evaluate(func_np, *mesh)
+    for w in weights[::-1]:
+        values = values @ w
+    return float(values)
+
+# doubling the number of nodes of the tensor-product quadrature until two estimations agree
+def _tensor_gauss_adaptive(func_np, intervals, tol=1e-8, nodes=None, max_points=2**22):
+    '''
+    - Return:
+        the integral and an estimation of its error
+    '''
+    if nodes is not None:
+        value = _tensor_gauss(func_np, intervals, nodes)
+        return value, abs(value - _tensor_gauss(func_np, intervals, max(nodes//2, 1)))
+
+    n = 8
+    value = last_value = _tensor_gauss(func_np, intervals, n)
+    while (2*n)**len(intervals) <= max_points:
+        n *= 2
+        last_value, value = value, _tensor_gauss(func_np, intervals, n)
+        if abs(value - last_value) <= tol*max(1, abs(value)):
+            break
+    return value, abs(value - last_value)
+
+#Surface Integral for a scalar field
+def surface_integral_scalar(field, surface, inter1, inter2, method='numeric', tol=1e-8, nodes=None):
+    '''
+    - Arguments:
+        `field`: Scalar field f(x,y,z)
+        `surface`: a parametric surface r(u,v) as a tuple with three components or a vector of sympy.vector
+        `inter1`: (parameter1, start, end)
+        `inter2`: (parameter2, start, end)
+        `method`: 'numeric' (default) uses a tensor-product Gauss-Legendre quadrature. 'symbolic' uses `sp.integrate`
+        `tol`: the relative tolerance of the numeric method
+        `nodes`: optional. a fixed number of nodes for each parameter in the numeric method
+    - Return:
+        the surface integral of the field, i.e. the integral of f(r(u,v))|r_u x r_v| du dv.
+        In the 'numeric' method, a tuple with the integral and an estimation of its error.
+
+    ===================
+    Example:
+        import sympy as sp
+        import av_utils as av
+        x,y,z,theta,phi = sp.symbols('x y z theta phi')
+        donut = ((2+sp.cos(phi))*sp.cos(theta), (2+sp.cos(phi))*sp.sin(theta), sp.sin(phi))
+        av.surface_integral_scalar(z**2, donut, (theta,0,2*sp.pi), (phi,0,2*sp.pi))
+    '''
+    assert method in ('symbolic', 'numeric'), "method must be 'symbolic' or 'numeric'"
+    u, v = inter1[0], inter2[0]
+    r = sp.Matrix(_components(surface))
+
+    # the norm of the fundamental vector product r_u x r_v
+    module = sp.sqrt(sum(c**2 for c in r.diff(u).cross(r.diff(v))))
+    integrand = _parametrize(sp.sympify(field), list(r))*module
+
+    if method == 'symbolic':
+        with _phase('simplify'):
+            integrand = integrand.simplify()
+        with _phase('integrate'):
+            return sp.integrate(integrand, (v, inter2[1], inter2[2]), (u, inter1[1], inter1[2])).evalf()
+
+    integrand_np = cached_lambdify([u, v], integrand, 'numpy')
+    return _tensor_gauss_adaptive(integrand_np, [inter1[1:], inter2[1:]], tol=tol, nodes=nodes)
+
+# sign (+1 or -1) that makes the normal vector r_u x r_v agree with the requested orientation
+def _orientation_sign(position, normal, inter1, inter2, orientation, center=None, points=16):
+    u, v = inter1[0], inter2[0]
+    sample_np = cached_lambdify([u, v], list(position) + list(normal), 'numpy', cse=True)
+    # the midpoints of the cells: on a closed direction (e.g. 0 to 2*pi) they are symmetric and cancel exactly
+    middle = (np.arange(points) + 0.5)/points
+    uu, vv = np.meshgrid(float(inter1[1]) + (float(inter1[2]) - float(inter1[1]))*middle,
+                         float(inter2[1]) + (float(inter2[2]) - float(inter2[1]))*middle, indexing='ij')
+    values = np.array([np.broadcast_to(np.asarray(val, dtype=float), uu.shape) for val in sample_np(uu, vv)])
+    r, n = values[:3].reshape(3, -1), values[3:].reshape(3, -1)
+
+    if isinstance(orientation, str):
+        assert orientation in ('outward', 'inward'), "orientation must be 'outward', 'inward' or a vector"
+        if center is None:
+            center = r.mean(axis=1)
+        direction = r - np.asarray(center, dtype=float).reshape(3, 1)
+    else:
+        direction = np.asarray(orientation, dtype=float).reshape(3, 1)
+
+    # the mean of direction.n must not vanish compared with the mean of its absolute value (e.g. a vector on a cylinder)
+    projection = np.sum(direction*n, axis=0)
+    alignment = projection.mean()
+    assert abs(alignment) > 1e-6*np.abs(projection).mean(), \
+        "the orientation of the surface can't be determined. Try giving the `center` of the closed surface"
+    sign = 1 if alignment > 0 else -1
+    return -sign if isinstance(orientation, str) and orientation == 'inward' else sign
+
+#Surface Integral for a vectorial field (flux)
+def surface_integral_vectorial(field, surface, inter1, inter2, orientation=None, center=None,
+                               method='numeric', tol=1e-8, nodes=None):
+    '''
+    - Arguments:
+        `field`: Vector field F(x,y,z) as a vector of sympy.vector or a tuple with three components
+        `surface`: a parametric surface r(u,v) as a tuple with three components or a vector of sympy.vector
+        `inter1`: (parameter1, start, end)
+        `inter2`: (parameter2, start, end)
+        `orientation`: optional. None uses the normal vector r_u x r_v as it is. 'outward' or 'inward' 
+        orient the normal vector with respect to `center`. A vector like (0,0,1) orients the normal vector along it.
+        `center`: optional. a point inside the closed surface. The default is the centroid of the surface
+        `method`: 'numeric' (default) uses a tensor-product Gauss-Legendre quadrature. 'symbolic' uses `sp.integrate`
+        `tol`: the relative tolerance of the numeric method
+        `nodes`: optional. a fixed number of nodes for each parameter in the numeric method
+    - Return:
+        the flux of the field through the surface, i.e. the integral of F(r(u,v)).(r_u x r_v) du dv.
+        In the 'numeric' method, a tuple with the flux and an estimation of its error.
+
+    ===================
+    Example:
+        import sympy as sp
+        import sympy.vector as sv
+        import av_utils as av
+        R = sv.CoordSys3D('R')
+        x,y,z,theta = sp.symbols('x y z theta')
+        cylinder = (sp.cos(theta), sp.sin(theta), z)
+        av.surface_integral_vectorial(x*R.i + y*R.j, cylinder, (theta,0,2*sp.pi), (z,0,1), orientation='outward')
+    '''
+    assert method in ('symbolic', 'numeric'), "method must be 'symbolic' or 'numeric'"
+    u, v = inter1[0], inter2[0]
+    r = sp.Matrix(_components(surface))
+
+    # the fundamental vector product is derived only once
+    normal = r.diff(u).cross(r.diff(v))
+    if orientation is not None:
+        normal = _orientation_sign(r, normal, inter1, inter2, orientation, center)*normal
+
+    field = [_parametrize(sp.sympify(f), list(r)) for f in _components(field)]
+    integrand = sum(f*n for f, n in zip(field, normal))
+
+    if method == 'symbolic':
+        with _phase('simplify'):
+            integrand = integrand.simplify()
+        with _phase('integrate'):
+            return sp.integrate(integrand, (v, inter2[1], inter2[2]), (u, inter1[1], inter1[2])).evalf()
+
+    integrand_np = cached_lambdify([u, v], integrand, 'numpy', cse=True)
+    return _tensor_gauss_adaptive(integrand_np, [inter1[1:], inter2[1:]], tol=tol, nodes=nodes)
+
+# applying a function to a list of tasks in a pool of processes. The order of the results is the same as the tasks
+def _pool_map(func, tasks, workers=None):
+    tasks = list(tasks)
+    if workers is None:
+        workers = min(len(tasks), os.cpu_count() or 1)
+    return list(_pool_imap(func, tasks, workers))
+
+# the same as _pool_map, but the results are yielded one by one as soon as they are ready
+def _pool_imap(func, tasks, workers=None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for task in tasks:
+            yield func(task)
+        return
+    with multiprocessing.Pool(workers) as pool:
+        yield from pool.imap(func, tasks)
+
+# the same as _pool_imap with threads, for functions that can't be pickled (e.g. compiled by lambdify).
+# At most `window` tasks are submitted ahead of the consumer, so the results don't pile up in memory
+def _thread_imap(func, tasks, workers=None, window=None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for task in tasks:
+            yield func(task)
+        return
+    if window is None:
+        window = 2*workers
+    with ThreadPool(workers) as pool:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(func, (task,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+# the task of a worker process in closed_surface_flux
+def _patch_flux(task):
+    field, surface, inter1, inter2, orientation, center, tol = task
+    return surface_integral_vectorial(field, surface, inter1, inter2, orientation=orientation,
+                                      center=center, tol=tol)[0]
+
+# Flux through a closed surface made of several patches and the volume integral of the divergence (Gauss theorem)
+def closed_surface_flux(field, patches, region=None, center=None, workers=None, tol=1e-8):
+    '''
+    - Arguments:
+        `field`: Vector field F(x,y,z) of class sympy.vector
+        `patches`: a list of tuples (surface, inter1, inter2, orientation), one for each patch of the closed surface.
+        `surface`, `inter1`, `inter2` and `orientation` are the same as in `surface_integral_vectorial`
+        `region`: optional. the solid bounded by the surface as a tuple (parametrization, inter1, inter2, inter3),
+        where the parametrization maps (u,v,w) to (x,y,z). For example ((r*sp.cos(theta), r*sp.sin(theta), z), (r,0,1), (theta,0,2*sp.pi), (z,0,1))
+        `center`: optional. a point inside the surface used by the 'outward' and 'inward' orientations. 
+        The default is the centroid of all the patches
+        `workers`: optional. the number of processes. The patches are integrated in parallel
+        `tol`: the relative tolerance of the numeric integrals
+    - Return:
+        the total flux, the volume integral of the divergence of the field (None without `region`)
+        and a list with the flux through each patch
+    
+    ===================
+    Example:
+        import sympy as sp
+        import sympy.vector as sv
+        import av_utils as av
+        R = sv.CoordSys3D('R')
+        x,y,z,r,theta = sp.symbols('x y z r theta')
+        F = x*R.i + y*R.j + z**2*R.k
+        side = ((sp.cos(theta), sp.sin(theta), z), (theta,0,2*sp.pi), (z,0,1), 'outward')
+        bottom = ((r*sp.cos(theta), r*sp.sin(theta), 0), (r,0,1), (theta,0,2*sp.pi), (0,0,-1))
+        top = ((r*sp.cos(theta), r*sp.sin(theta), 1), (r,0,1), (theta,0,2*sp.pi), (0,0,1))
+        cylinder = ((r*sp.cos(theta), r*sp.sin(theta), z), (r,0,1), (theta,0,2*sp.pi), (z,0,1))
+        av.closed_surface_flux(F, [side, bottom, top], region=cylinder)
+    '''
+    if center is None:
+        # the centroid of all the patches is inside the closed surface for convex solids
+        centroids = []
+        for surface, inter1, inter2, orientation in patches:
+            position_np = cached_lambdify([inter1[0], inter2[0]], list(_components(surface)), 'numpy')
+            uu, vv = np.meshgrid(np.linspace(float(inter1[1]), float(inter1[2]), 16),
+                                 np.linspace(float(inter2[1]), float(inter2[2]), 16))
+            centroids.append([np.mean(np.broadcast_to(np.asarray(c, dtype=float), uu.shape)) for c in position_np(uu, vv)])
+        center = np.mean(centroids, axis=0)
+
+    tasks = [(field, surface, inter1, inter2, orientation, tuple(center), tol)
+             for surface, inter1, inter2, orientation in patches]
+    fluxes = _pool_map(_patch_flux, tasks, workers)
+
+    volume = None
+    if region is not None:
+        R = list(field.separate().keys())[0]
+        param_field = [p for p in field.free_symbols if not p.is_Vector]
+        div = divergence(field, param_field, coordinate=R)
+
+        position, inter1, inter2, inter3 = region
+        position = sp.Matrix(_components(position))
+        jacobian = position.jacobian([inter1[0], inter2[0], inter3[0]]).det()
+        integrand = _parametrize(div, list(position))*sp.Abs(jacobian)
+        integrand_np = cached_lambdify([inter1[0], inter2[0], inter3[0]], integrand, 'numpy', cse=True)
+        volume = _tensor_gauss_adaptive(integrand_np, [inter1[1:], inter2[1:], inter3[1:]], tol=tol)[0]
+
+    return sum(fluxes), volume, fluxes
+
+# Halton sequence in `dim` dimensions from the index `start` to `start + n`
+def _halton(start, n, dim):
+    primes = [2, 3, 5, 7, 11, 13][:dim]
+    points = np.zeros((dim, n))
+    for d, base in enumerate(primes):
+        index = np.arange(start + 1, start + n + 1)
+        factor = 1.0
+        while np.any(index > 0):
+            factor /= base
+            points[d] += factor*(index % base)
+            index //= base
+    return points
+
+# the task of a worker process in volume_integral: the sums of the integrand on a chunk of points for each shift
+def _qmc_chunk(task):
+    func, region, vars, box, sequence, start, n, shifts = task
+    func_np = cached_lambdify(vars, func, 'numpy')
+    region_np = cached_lambdify(vars, region, 'numpy') if region is not None else None
+    low, high = box[:, 0:1], box[:, 1:2]
+
+    sums = np.empty(len(shifts))
+    for ind, shift in enumerate(shifts):
+        if sequence == 'halton':
+            # random shift (Cranley-Patterson rotation) of the same Halton points
+            unit = (_halton(start, n, len(vars)) + shift[:, None]) % 1
+        else:
+            from scipy.stats import qmc
+            sampler = qmc.Sobol(len(vars), scramble=True, seed=int(shift[0]*2**31))
+            if start > 0:
+                sampler.fast_forward(start)
+            unit = sampler.random(n).T
+        points = low + (high - low)*unit
+        values = _evaluate(func_np, *points)
+        if region_np is not None:
+            values = np.where(np.broadcast_to(region_np(*points), values.shape), values, 0)
+        sums[ind] = values.sum()
+    return sums
+
+# Volume integral over a region given by inequalities using Quasi-Monte Carlo points
+def volume_integral(func, region, inter1, inter2, inter3, points=2**18, chunk=2**14, sequence='halton',
+                    shifts=8, tol=None, workers=1, seed=None, verbose=0):
+    '''
+    - Arguments:
+        `func`: a scalar field f(x,y,z) as a Sympy object, for example the output of `divergence`
+        `region`: an inequality or a combination of inequalities with sp.And, e.g. x**2+y**2+z**2 <= 1.
+        None integrates over the whole box
+        `inter1`, `inter2`, `inter3`: (variable, start, end). The box that contains the region
+        `points`: the maximum number of points for each shift
+        `chunk`: the number of points evaluated at once. It bounds the memory
+        `sequence`: 'halton' or 'sobol'. 'sobol' needs scipy
+        `shifts`: the number of independent randomizations of the sequence used to estimate the error
+        `tol`: optional. the evaluation stops when the estimated error is less than `tol`
+        `workers`: the number of processes that evaluate the chunks. None uses all the cores
+        `seed`: optional. the seed of the random shifts
+        `verbose`: 1 prints the running estimate after each chunk
+    - Return:
+        the integral and an estimation of its error (the standard error of the shifts)
+
+    ===================
+    Example:
+        import sympy as sp
+        import sympy.vector as sv
+        import av_utils as av
+        R = sv.CoordSys3D('R')
+        x,y,z = sp.symbols('x y z')
+        div = av.divergence(x**3*R.i + y**3*R.j + z**3*R.k, (x,y,z))
+        av.volume_integral(div, x**2+y**2+z**2 <= 1, (x,-1,1), (y,-1,1), (z,-1,1))
+    '''
+    assert sequence in ('halton', 'sobol'), "sequence must be 'halton' or 'sobol'"
+    intervals = [inter1, inter2, inter3]
+    vars = [inter[0] for inter in intervals]
+    box = np.array([[float(inter[1]), float(inter[2])] for inter in intervals])
+    box_volume = np.prod(box[:, 1] - box[:, 0])
+    random_shifts = np.random.default_rng(seed).random((shifts, len(vars)))
+
+    tasks = ((sp.sympify(func), region, vars, box, sequence, start, min(chunk, points - start), random_shifts)
+             for start in range(0, points, chunk))
+
+    sums, count = np.zeros(shifts), 0
+    results = _pool_imap(_qmc_chunk, tasks, workers)
+    for start, chunk_sums in zip(range(0, points, chunk), results):
+        sums += chunk_sums
+        count += min(chunk, points - start)
+        estimates = box_volume*sums/count
+        value, error = estimates.mean(), estimates.std(ddof=1)/np.sqrt(shifts) if shifts > 1 else np.nan
+        if verbose == 1:
+            print(f"{count} points, the integral is {value} +- {error}")
+        if tol is not None and error < tol:
+            results.close()
+            break
+
+    return float(value), float(error)
+
+# evaluating the components of a field on a grid with one compiled function
+def _evaluate_on_grid(components, xyz, grid):
+    '''
+    - Arguments:
+        `components`: a list of Sympy expressions in the variables `xyz`
+        `xyz`: the variables (x, y, z)
+        `grid`: an array of points with the shape (N,3) or (N,2), or a tuple of arrays (X,Y,Z) or (X,Y) like the output of np.meshgrid
+    - Return:
+        for an array of points, an array with the shape (N, number of components).
+        for a tuple of arrays, an array with the shape (number of components, *X.shape)
+    '''
+    func_np = _fused_lambdify(xyz, components)
+
+    if isinstance(grid, np.ndarray) and grid.ndim == 2:
+        assert grid.shape[1] in (2, 3), 'the points must have two or three coordinates'
+        coords = [grid[:, 0], grid[:, 1], grid[:, 2] if grid.shape[1] == 3 else np.zeros(len(grid))]
+        return func_np(*coords).T
+
+    assert len(grid) in (2, 3), 'the grid must have two or three arrays'
+    coords = [np.asarray(c, dtype=float) for c in grid]
+    if len(coords) == 2:
+        coords.append(np.zeros(np.broadcast(*coords).shape))
+    return func_np(*coords)
+
 # gradient in Cartesian coordinate system
-def gradient(func, vars, point=None, coordinate=None):
+def gradient(func, vars, point=None, coordinate=None, grid=None):
     """
     - Arguments:
         `func`: A function with 2 or 3 variables in the Cartesian coordinate system (x,y) or (x,y,z). 
         `vars`: variables of the function
         `point`: optional. A point in the plano or space.
         `coordinate`: optional. The name of the coordinate system.
+        `grid`: optional. an array of points with the shape (N,3) or a tuple of arrays (X,Y,Z) like the output of np.meshgrid.
+        The result is evaluated on the points with a single compiled function and returned as a NumPy array.
     - Return:
-        The gradient of the function
+        The gradient of the function. With `grid`, an array with the shape (N,3) or (3, *X.shape)
     """
     #vars = (list(sp.ordered(func.free_symbols)))
 
@@ -1274,6 +3019,9 @@ def gradient(func, vars, point=None, coordinate=None):
     #if len(vars) == 2:
         
             
+    if grid is not None:
+        return _evaluate_on_grid([func.diff(x), func.diff(y), func.diff(z)], [x, y, z], grid)
+
     grad = func.diff(x)*R.i + func.diff(y)*R.j + func.diff(z)*R.k
     
     
@@ -1287,15 +3035,17 @@ def gradient(func, vars, point=None, coordinate=None):
 
 
 # Curl in the Cartesian coordinate system   
-def curl(func, vars, point=None, coordinate=None):
+def curl(func, vars, point=None, coordinate=None, grid=None):
     """
     - Arguments:
         `func`: A function with 3 variables in the Cartesian coordinate system (x,y,z).
         `vars`: variables of the function
         `point`: optional. A point in the plano or space.
         `coordinate`: optional. The name of the coordinate system.
+        `grid`: optional. an array of points with the shape (N,3) or a tuple of arrays (X,Y,Z) like the output of np.meshgrid.
+        The result is evaluated on the points with a single compiled function and returned as a NumPy array.
     - Return:
-        The curl of the function
+        The curl of the function. With `grid`, an array with the shape (N,3) or (3, *X.shape)
     """
     x = [var for var in vars if var.name=='x']
     y = [var for var in vars if var.name=='y']
@@ -1326,6 +3076,10 @@ def curl(func, vars, point=None, coordinate=None):
     curl_x = func_z.diff(y) - func_y.diff(z)
     curl_y = func_x.diff(z) - func_z.diff(x)
     curl_z = func_y.diff(x) - func_x.diff(y)
+
+    if grid is not None:
+        return _evaluate_on_grid([curl_x, curl_y, curl_z], [x, y, z], grid)
+
     curl = curl_x*R.i + curl_y*R.j + curl_z*R.k
     
     if point:
@@ -1334,15 +3088,17 @@ def curl(func, vars, point=None, coordinate=None):
     return curl
     
 # Divergent in the Cartesian coordinate system
-def divergence(func, vars, point=None, coordinate=None):
+def divergence(func, vars, point=None, coordinate=None, grid=None):
     """
     - Arguments:
         `func`: A function with 3 or 3 variables in the Cartesian coordinate system (x,y,z). 
         `vars`: variables of the function
         `point`: optional. A point in the plano or space.
         `coordinate`: optional. The name of the coordinate system.
+        `grid`: optional. an array of points with the shape (N,3) or a tuple of arrays (X,Y,Z) like the output of np.meshgrid.
+        The result is evaluated on the points with a single compiled function and returned as a NumPy array.
     - Return:
-        The divergent of the function
+        The divergent of the function. With `grid`, an array with the shape (N,) or X.shape
     """
     x = [var for var in vars if var.name=='x']
     y = [var for var in vars if var.name=='y']
@@ -1371,52 +3127,154 @@ def divergence(func, vars, point=None, coordinate=None):
 
     div = func_x.diff(x) + func_y.diff(y) + func_z.diff(z)
 
+    if grid is not None:
+        values = _evaluate_on_grid([div], [x, y, z], grid)
+        return values[:, 0] if isinstance(grid, np.ndarray) and grid.ndim == 2 else values[0]
+
     if point:
         div = div.subs({x:point[0], y:point[1], z:point[2]})
     
     return div
     
-# finding the minimum of an univariate function using gradient descent
-def minimum(func, a, alpha=0.01, epochs=100, precision=0.0001):
+# Brent method with derivatives (like dbrent of Numerical Recipes) applied to many brackets at once
+def _brent_batch(f, deriv, a, b, x, tol=1e-12, maxiter=100):
+    '''
+    - Arguments:
+        `f`, `deriv`: the vectorized function and its derivative
+        `a`, `b`: arrays with the brackets of the minima
+        `x`: arrays with the best point of each bracket, a <= x <= b
+    - Return:
+        an array with the minima
+    '''
+    a, b, x = [np.array(arr, dtype=float) for arr in (a, b, x)]
+    fx, dx = _evaluate(f, x).copy(), _evaluate(deriv, x).copy()
+    v, fv, dv = x.copy(), fx.copy(), dx.copy()
+    w, fw, dw = x.copy(), fx.copy(), dx.copy()
+    d, e = np.zeros_like(x), np.zeros_like(x)
+    done = np.zeros(x.shape, dtype=bool)
+
+    for it in range(maxiter):
+        xm = 0.5*(a + b)
+        tol1 = tol*np.abs(x) + 1e-20
+        tol2 = 2*tol1
+        done |= np.abs(x - xm) <= (tol2 - 0.5*(b - a))
+        if done.all():
+            break
+
+        # the secant steps on the derivative using the two last points
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d1 = np.where(dw != dx, (w - x)*dx/(dx - dw), 2*(b - a))
+            d2 = np.where(dv != dx, (v - x)*dx/(dx - dv), 2*(b - a))
+        ok1 = ((a - x - d1)*(x + d1 - b) > 0) & (dx*d1 <= 0)
+        ok2 = ((a - x - d2)*(x + d2 - b) > 0) & (dx*d2 <= 0)
+        secant = np.where(ok1 & ok2, np.where(np.abs(d1) < np.abs(d2), d1, d2), np.where(ok1, d1, d2))
+
+        olde = e
+        use_secant = (np.abs(e) > tol1) & (ok1 | ok2) & (np.abs(secant) <= np.abs(0.5*olde))
+        # otherwise bisection towards the side that the derivative points to
+        e = np.where(np.abs(e) > tol1, d, e)
+        bisection = np.where(dx >= 0, a - x, b - x)
+        e = np.where(use_secant, e, bisection)
+        d = np.where(use_secant, secant, 0.5*bisection)
+
+        near_border = use_secant & (((x + d - a) < tol2) | ((b - x - d) < tol2))
+        d = np.where(near_border, np.copysign(tol1, xm - x), d)
+
+        small = np.abs(d) < tol1
+        # the minimal step must not leave the bracket (e.g. a minimum at the end of the interval)
+        u = np.clip(np.where(small, x + np.copysign(tol1, d), x + d), a, b)
+
+        act = np.flatnonzero(~done)
+        fu, du = np.full(x.shape, np.inf), np.zeros_like(x)
+        fu[act], du[act] = _evaluate(f, u[act]), _evaluate(deriv, u[act])
+
+        # a minimal step that doesn't decrease the function means convergence
+        done |= small & (fu >= fx)
+        act = ~done
+        better = act & (fu <= fx)
+        worse = act & ~better
+
+        a = np.where(better & (u >= x), x, np.where(worse & (u < x), u, a))
+        b = np.where(better & (u < x), x, np.where(worse & (u >= x), u, b))
+
+        move_w = better | (worse & ((fu <= fw) | (w == x)))
+        move_v = worse & ~move_w & ((fu <= fv) | (v == x) | (v == w))
+        v, fv, dv = [np.where(move_w, w_, np.where(move_v, u_, v_)) for v_, w_, u_ in ((v, w, u), (fv, fw, fu), (dv, dw, du))]
+        w, fw, dw = [np.where(better, x_, np.where(move_w, u_, w_)) for w_, x_, u_ in ((w, x, u), (fw, fx, fu), (dw, dx, du))]
+        x, fx, dx = [np.where(better, u_, x_) for x_, u_ in ((x, u), (fx, fu), (dx, du))]
+
+    return x
+
+# finding the minimum of an univariate function
+def minimum(func, a, alpha=0.01, epochs=100, precision=0.0001, method='brent', tol=1e-12, points=100):
     '''
     - Arguments:
         `func`: uma função no formato de Sympy
-        `a`: um tuple (varivel da função, inicio, fim)
+        `a`: um tuple (varivel da função, inicio, fim), ou uma lista de tuples para buscar o minimo em varios intervalos
+        `method`: 'brent' (default) brackets the minimum with a coarse scan and refines it with the Brent method using
+        the derivative. 'gradient' uses gradient descent with the steps `alpha`, `epochs` and `precision`
+        `tol`: the relative tolerance of the Brent method
+        `points`: the number of points of the coarse scan
     - Return:
         the value of the variable where the function has its minimum inside the interval.
+        For a list of intervals, an array with the minimum of each one.
     '''
+    assert method in ('brent', 'gradient'), "method must be 'brent' or 'gradient'"
+    # a list of intervals, not one interval written as a list like [x, 0, 3]
+    batch = isinstance(a[0], (tuple, list))
+    intervals = a if batch else [a]
+    var = intervals[0][0]
+
     #fining the derivative of the func
-    derivative = func.diff()
+    derivative = func.diff(var)
     #grads = np.zeros((epochs,2))
 
     #lambdify
-    f = sp.lambdify(a[0], func, 'numpy')
-    deriv = sp.lambdify(a[0], derivative, 'numpy')
-
-    #finding an aproximation of the mininum by a random search
-    l = np.linspace(a[1],a[2], 100)
-    f_min_index = np.argmin(f(l))
-    local_min = l[f_min_index]
-
-    #print(f"inicial local_min is {local_min}")
-
-    # starting the gradient descent
-    for epoch in range(epochs):
-        last_local_min = local_min
-        local_min -= alpha * deriv(local_min)
-        #print(f"the {epoch}th local_min is {local_min}")
-        #grads[epoch,:] = local_min, f(local_min)
-        
-        if abs(f(local_min) - f(last_local_min)) < precision:
-            print('reached the precision')
-            break
-        
-        if local_min > a[2] or local_min < a[1]:
-            local_min = last_local_min
-            print('out of interval')
-            break
+    f = cached_lambdify(var, func, 'numpy')
+    deriv = cached_lambdify(var, derivative, 'numpy')
+
+    if method == 'brent':
+        start = np.array([float(inter[1]) for inter in intervals])
+        end = np.array([float(inter[2]) for inter in intervals])
+
+        # the coarse scan of all the intervals at once gives the brackets
+        l = start[:, None] + (end - start)[:, None]*np.linspace(0, 1, points)
+        f_min_index = np.argmin(_evaluate(f, l), axis=1)
+        rows = np.arange(len(intervals))
+        x = l[rows, f_min_index]
+        low = l[rows, np.maximum(f_min_index - 1, 0)]
+        high = l[rows, np.minimum(f_min_index + 1, points - 1)]
+
+        local_min = _brent_batch(f, deriv, low, high, x, tol=tol)
+        return local_min if batch else float(local_min[0])
+
+    local_mins = []
+    for a in intervals:
+        #finding an aproximation of the mininum by a random search
+        l = np.linspace(a[1],a[2], points)
+        f_min_index = np.argmin(f(l))
+        local_min = l[f_min_index]
+
+        #print(f"inicial local_min is {local_min}")
+
+        # starting the gradient descent
+        for epoch in range(epochs):
+            last_local_min = local_min
+            local_min -= alpha * deriv(local_min)
+            #print(f"the {epoch}th local_min is {local_min}")
+            #grads[epoch,:] = local_min, f(local_min)
+            
+            if abs(f(local_min) - f(last_local_min)) < precision:
+                print('reached the precision')
+                break
+            
+            if local_min > a[2] or local_min < a[1]:
+                local_min = last_local_min
+                print('out of interval')
+                break
+        local_mins.append(local_min)
 
-    return local_min #,grads
+    return np.array(local_mins) if batch else local_mins[0] #,grads
 
 def halley(func, var, x0=0, epochs = 500, tol=1e-5, epsilon = 1e-10):
     """
@@ -1433,9 +3291,9 @@ def halley(func, var, x0=0, epochs = 500, tol=1e-5, epsilon = 1e-10):
     df = func.diff(var)
     ddf = df.diff(var)
     
-    f_numpy = sp.lambdify(var,func,'numpy')
-    df_numpy = sp.lambdify(var,df, 'numpy')
-    ddf_numpy = sp.lambdify(var,ddf, 'numpy')
+    f_numpy = cached_lambdify(var,func,'numpy')
+    df_numpy = cached_lambdify(var,df, 'numpy')
+    ddf_numpy = cached_lambdify(var,ddf, 'numpy')
     
     x = x0
     for i in range(epochs):
@@ -1456,6 +3314,57 @@ def halley(func, var, x0=0, epochs = 500, tol=1e-5, epsilon = 1e-10):
         
     return float(x)
 
+# all the roots of a function inside an interval with the Halley method starting from many points at once
+def halley_roots(func, inter, seeds=200, epochs=100, tol=1e-10, epsilon=1e-12, distinct=1e-6):
+    """
+    - Argumentos:
+    `func`: o lado esquerdo da equação f(x)=0
+    `inter`: um tuple (variavel da função, inicio, fim)
+    `seeds`: o numero de chutes iniciais distribuidos no intervalo
+    `epochs`: o numero maximo de iterações
+    `tol`: a tolerancia para aproximação de cada raiz
+    `epsilon`: zero numerico. Os chutes com denominador menor que epsilon vezes o numerador são descartados
+    `distinct`: a distancia minima entre duas raizes diferentes
+    - Return:
+    um array com as raizes distintas da função dentro do intervalo, em ordem crescente.
+    """
+    var = inter[0]
+    df = func.diff(var)
+    ddf = df.diff(var)
+    # f, f' and f'' are computed by a single function
+    derivatives = cached_lambdify(var, [func, df, ddf], 'numpy', cse=True)
+
+    start, end = float(inter[1]), float(inter[2])
+    x = np.linspace(start, end, seeds)
+    active = np.ones(seeds, dtype=bool)
+    converged = np.zeros(seeds, dtype=bool)
+
+    for i in range(epochs):
+        if not active.any():
+            break
+        index = np.flatnonzero(active)
+        f, d, dd = [np.broadcast_to(np.asarray(val, dtype=float), index.shape) for val in derivatives(x[index])]
+        nom = 2*f*d
+        denom = 2*d**2 - f*dd
+
+        # the denominator is compared with the nominator, because both vanish at a multiple root
+        bad = ~(np.abs(denom) > epsilon*np.abs(nom)) | (denom == 0)
+        step = np.where(bad, 0, nom/np.where(bad, 1, denom))
+        x[index] -= step
+
+        # a small step is not enough at a critical point where f isn't zero
+        done = ~bad & (np.abs(step) < tol) & (np.abs(f) <= 10*tol*np.abs(d) + epsilon)
+        bad |= (np.abs(step) < tol) & ~done
+        out = (x[index] < start) | (x[index] > end)
+        converged[index[done & ~out]] = True
+        active[index[done | bad | out]] = False
+
+    roots = np.sort(x[converged])
+    if len(roots) == 0:
+        return roots
+    keep = np.concatenate([[True], np.diff(roots) > distinct])
+    return roots[keep]
+
 # constructing the parametric equation of a line using two points
 def line(a,b, coordinate=None):
     """
@@ -1523,52 +3432,120 @@ def cartesian_to_polar(func):
             func = func.subs(var, r*sp.cos(theta))
         if var.name == 'y':
             func = func.subs(var,r*sp.sin(theta))
-    return func.simplify()
+    with _phase('simplify'):
+        return func.simplify()
 
 
 # Integration by Riemannian Sum
-def riemann_sum(func,a,b,N,method='midpoint'):
-    '''Compute the Riemann sum of f(x) over the interval [a,b].
+def riemann_sum(func,a,b,N,method='midpoint',vars=None):
+    '''Compute the Riemann sum of f(x) over the interval [a,b], or of f(x,y,...) over a rectangular domain.
     
     Credit to: https://www.math.ubc.ca/~pwalls/math-python/integration/riemann-sums/
     
     Parameters
     ----------
-    `func` : function
-        Vectorized function of one variable
-    `a` , `b` : numbers
-        Endpoints of the interval [a,b]
-    `N` : integer
-        Number of subintervals of equal length in the partition of [a,b]
+    `func` : sympy expression
+        Function of one or more variables
+    `a` , `b` : numbers or sequences of numbers
+        Endpoints of the interval [a,b], or the lower and upper corners of the domain
+    `N` : integer or list of integers
+        Number of subintervals of equal length in the partition of [a,b] along each variable.
+        A list computes a convergence study with the function compiled once. When each N divides the next one
+        (by an odd factor, e.g. 3, for `midpoint`) the grids are nested and the function is evaluated only on the finest one.
+        Otherwise each N is evaluated on its own points
     `method` : string
         Determines the kind of Riemann sum:
         `right` : Riemann sum using right endpoints
         `left` : Riemann sum using left endpoints
         `midpoint` (default) : Riemann sum using midpoints
+        `trapezoid` : trapezoidal rule
+        `simpson` : Simpson's rule (N must be even)
+    `vars` : sequence of symbols
+        The order of the variables in `a` and `b`. By default the free symbols sorted by name
 
     Returns
     -------
     float
         Approximation of the integral given by the Riemann sum.
+    DataFrame
+        If N is a list: the columns N, value, difference (to the previous N), order (the observed order of convergence)
+        and richardson (the value after Richardson extrapolation with the previous N)
     '''
-    a, b = float(a), float(b)
-    dx = (b - a)/N
-    x = np.linspace(a,b,N+1)
-    
-    var = list(func.free_symbols)[0]
-    f_np = sp.lambdify(var, func)
+    if method not in _riemann_orders:
+        raise ValueError("Method must be 'left', 'right', 'midpoint', 'trapezoid' or 'simpson'.")
 
+    if isinstance(a, Iterable):
+        a, b = [float(item) for item in a], [float(item) for item in b]
+        assert len(a) == len(b), "a and b must have the same number of elements"
+    else:
+        a, b = [float(a)], [float(b)]
+    dim = len(a)
+
+    if vars is None:
+        vars = sorted(func.free_symbols, key=lambda var: var.name)
+        if not vars:
+            vars = [sp.Dummy() for _ in range(dim)]
+    assert len(vars) == dim, "the number of variables must be the same as the number of intervals"
+    assert func.free_symbols <= set(vars), "The variables of the function aren't the same as the declared in vars"
+    f_np = cached_lambdify(vars, func)
+
+    sweep = isinstance(N, Iterable)
+    levels = [int(n) for n in N] if sweep else [int(N)]
+    rules = [_riemann_rule(n, method) for n in levels]
+
+    # all the points are on a lattice with 2*lcm(N) subintervals. When the partitions are nested (every N divides the
+    # next one, by 3 for midpoint) the points of the finest one contain the others and the function is evaluated once.
+    # Otherwise (e.g. midpoint with N doubling) each partition is evaluated on its own points
+    lattice = math.lcm(*levels)
+    used = np.unique(np.concatenate([index*(lattice//n) for (index, _), n in zip(rules, levels)]))
+    nested = len(used) == max(len(index) for index, _ in rules)
+    if nested:
+        axes = [start + used*(end - start)/(2*lattice) for start, end in zip(a, b)]
+        values = _evaluate(f_np, *np.meshgrid(*axes, indexing='ij', sparse=True))
+
+    sums = []
+    for (index, weights), n in zip(rules, levels):
+        if nested:
+            position = np.searchsorted(used, index*(lattice//n))
+            total = values[np.ix_(*dim*[position])]
+        else:
+            axes = [start + index*(end - start)/(2*n) for start, end in zip(a, b)]
+            total = _evaluate(f_np, *np.meshgrid(*axes, indexing='ij', sparse=True))
+        for start, end in zip(a, b):
+            total = np.tensordot(weights*(end - start)/n, total, axes=(0, 0))
+        sums.append(float(total))
+
+    if not sweep:
+        return sums[0]
+
+    order = _riemann_orders[method]
+    table = pd.DataFrame({'N': levels, 'value': sums})
+    table['difference'] = table['value'].diff()
+    ratio = table['N']/table['N'].shift()
+    table['order'] = np.log(np.abs(table['difference'].shift()/table['difference']))/np.log(ratio)
+    table['richardson'] = table['value'] + table['difference']/(ratio**order - 1)
+    return table
+
+# the order of the error of the rules of riemann_sum
+_riemann_orders = {'left': 1, 'right': 1, 'midpoint': 2, 'trapezoid': 2, 'simpson': 4}
+
+# the points of a rule of riemann_sum with N subintervals, in units of half a subinterval, and their weights
+def _riemann_rule(N, method):
+    k = np.arange(N + 1)
     if method == 'left':
-        x_left = x[:-1]
-        return np.sum(f_np(x_left)*dx)
+        return 2*k[:-1], np.ones(N)
     elif method == 'right':
-        x_right = x[1:]
-        return np.sum(f_np(x_right)*dx)
+        return 2*k[1:], np.ones(N)
     elif method == 'midpoint':
-        x_mid = (x[:-1] + x[1:])/2
-        return np.sum(f_np(x_mid)*dx)
-    else:
-        raise ValueError("Method must be 'left', 'right' or 'midpoint'.")
+        return 2*k[:-1] + 1, np.ones(N)
+    elif method == 'trapezoid':
+        weights = np.ones(N + 1)
+        weights[[0, -1]] = 1/2
+        return 2*k, weights
+    assert N % 2 == 0, "Simpson's rule needs an even number of subintervals"
+    weights = np.where(k % 2 == 1, 4, 2)/3
+    weights[[0, -1]] = 1/3
+    return 2*k, weights
 
 # This function is needed in the multivariate gradient descent
 def _gradient(func, vars):
@@ -1587,15 +3564,25 @@ def _gradient(func, vars):
     return grad
 
 # multivariate gradient descent
-def gradient_descent(func, intervals, alpha=0.01, epochs=100, precision=None, verbose=0, return_points=False):
+def gradient_descent(func, intervals, alpha=0.01, epochs=100, precision=None, verbose=0, return_points=False,
+                     seeds=None, tol=1e-4, seed=None, gtol=1e-5):
     '''
     - Arguments:
         `func`: function. a function of Sympy with 2 or 3 variables
         `intervals`: tuple. a tuple of intervals each one in the format (varivel da função, inicio, fim)
         `alpha`: float. the length of steps
         `epochs`: integer. the number of iterations
+        `seeds`: optional. the number of random starting points. All of them are updated together
+        as an array of shape (seeds, number of variables). The steps are clipped to the intervals and
+        each seed stops when the norm of its (clipped) gradient is smaller than `gtol`. If the lowest
+        point wasn't reached by a seed that stopped in `epochs`, it is returned too with a warning
+        `tol`: the distance under which two minima found from different seeds are the same
+        `seed`: optional. the seed of the random starting points
+        `gtol`: the norm of the gradient under which a seed stops
     - Return:
         the value of the variable where the function has its minimum inside the interval.
+        With `seeds`, an array with the distinct minima sorted by the value of the function
+        (and the values of the function at them if `return_points` is True).
     '''
     vars = [var[0] for var in intervals]
     # to insure the order of the variables in the intervals
@@ -1605,13 +3592,16 @@ def gradient_descent(func, intervals, alpha=0.01, epochs=100, precision=None, ve
     #fining the derivative of the func
     df = _gradient(func, vars)
     
+    if seeds is not None:
+        return _gradient_descent_batch(func, df, vars, intervals, alpha, epochs, precision, verbose,
+                                       return_points, seeds, tol, seed, gtol)
 
     grads = np.zeros((epochs,len(vars)+1))
 
     #lambdify
-    f = sp.lambdify(vars, func, 'numpy')
+    f = cached_lambdify(vars, func, 'numpy')
 
-    df_np = sp.lambdify(vars, df, 'numpy')
+    df_np = cached_lambdify(vars, df, 'numpy')
     
     #finding an aproximation of the mininum by a random search
     points = [np.linspace(var[1],var[2],100) for var in intervals]
@@ -1656,4 +3646,65 @@ def gradient_descent(func, intervals, alpha=0.01, epochs=100, precision=None, ve
     if return_points:
         return local_min ,grads
     else:
-        return local_min 
\ No newline at end of file
+        return local_min 
+
+# gradient descent of many starting points at once. It is used by gradient_descent when `seeds` is given
+def _gradient_descent_batch(func, df, vars, intervals, alpha, epochs, precision, verbose, return_points, seeds, tol, seed,
+                            gtol):
+    f = cached_lambdify(vars, func, 'numpy')
+    df_np = cached_lambdify(vars, df, 'numpy', cse=True)
+
+    bounds = {inter[0]: (float(inter[1]), float(inter[2])) for inter in intervals}
+    low = np.array([bounds[var][0] for var in vars])
+    high = np.array([bounds[var][1] for var in vars])
+
+    points = low + (high - low)*np.random.default_rng(seed).random((seeds, len(vars)))
+    values = _evaluate(f, *points.T).copy()
+    active = np.ones(seeds, dtype=bool)
+    converged = np.zeros(seeds, dtype=bool)
+
+    for epoch in range(epochs):
+        if not active.any():
+            break
+        current = points[active]
+        step = np.stack([np.broadcast_to(np.asarray(g, dtype=float), len(current)) for g in df_np(*current.T)], axis=1)
+        # the steps that leave the interval are clipped to its boundary, so the minima on the boundary are found too
+        new_points = np.clip(current - alpha*step, low, high)
+        new_values = _evaluate(f, *new_points.T)
+
+        # a seed stops when its (clipped) gradient is smaller than gtol
+        done = np.linalg.norm(new_points - current, axis=1) < alpha*gtol
+        if precision is not None:
+            done |= np.abs(new_values - values[active]) < precision
+
+        index = np.flatnonzero(active)
+        points[index], values[index] = new_points, new_values
+        active[index[done]] = False
+        converged[index[done]] = True
+
+        if verbose == 1:
+            print(f"Epoch {epoch+1}, {active.sum()} active seeds, the minimum value of function is {values.min()}")
+
+    # removing the repeated minima and the seeds that didn't converge, except the lowest one
+    order = [ind for ind in np.argsort(values) if np.isfinite(values[ind])]
+    minima = []
+    if order and not converged[order[0]]:
+        print(f"the lowest point {points[order[0]]} didn't converge in {epochs} epochs. Increase epochs or alpha")
+        minima.append(order[0])
+    for ind in order:
+        if not converged[ind]:
+            continue
+        if all(np.linalg.norm(points[ind] - points[m]) > tol for m in minima):
+            minima.append(ind)
+
+    if return_points:
+        return points[minima], values[minima]
+    else:
+        return points[minima]
+
+
+# the public functions are timed by `profile`
+for _name, _func in list(globals().items()):
+    if (callable(_func) and getattr(_func, '__module__', None) == __name__ and not isinstance(_func, type)
+            and not _name.startswith('_') and _name != 'profile'):
+        globals()[_name] = _profiled(_func)